@@ -3,123 +3,283 @@ Configuration module for Ultra Fast Video Banner Bot
 تنظیمات ربات فوق سریع اضافه کردن بنر به ویدیو
 """
 
+from __future__ import annotations
+
+import functools
 import os
-from pathlib import Path
-from typing import Optional
+import sys
+from types import MappingProxyType
+
+try:
+    # Pre-parsed copy of .env generated by setup_environment()
+    from env_cache import ENV as _ENV_CACHE
+except ImportError:
+    _ENV_CACHE = {}
+
+ENV_CACHE_FILE = 'env_cache.py'
+
+# Accepted spellings for boolean env flags (avoids a .lower() per lookup)
+_TRUTHY = frozenset({'1', 'true', 'True', 'TRUE', 'yes', 'Yes', 'YES', 'y', 'Y'})
+
+# (settings fingerprint, resulting USE_USER_CLIENT) of the last successful validation
+_VALIDATED_FINGERPRINT: tuple | None = None
+
+# Directories already known to exist in this process
+_ENSURED_DIRS: set = set()
+
+def _ensure_dir(path: str):
+    """Create a directory once, skipping the syscall if already ensured"""
+    if not path or path in _ENSURED_DIRS:
+        return
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    _ENSURED_DIRS.add(path)
+
+# Eagerly loaded settings: (name, type, default); sys.intern marks interned strings
+_SCHEMA = (
+    # Bot API Configuration
+    ('BOT_TOKEN', str, ''),
+    ('OWNER_ID', int, None),
+    
+    # User Client Configuration (Optional)
+    ('USE_USER_CLIENT', bool, True),
+    
+    # File Configuration
+    ('MAX_FILE_SIZE', int, 2 * 1024 * 1024 * 1024),  # 2GB
+    ('TEMP_DIR', str, 'temp'),
+    
+    # Performance Configuration
+    ('MAX_WORKERS', int, 4),
+    ('PROCESSING_TIMEOUT', int, 600),  # 10 minutes
+    ('STREAM_ENCODE', bool, False),  # encode while downloading (User Client, POSIX only)
+    
+    # Network Tuning (Linux, optional; see README)
+    ('SOCKET_BUSY_POLL', int, 0),  # SO_BUSY_POLL microseconds, 0 = off
+    
+    # FFmpeg Configuration
+    ('FFMPEG_PRESET', sys.intern, 'ultrafast'),
+    ('FFMPEG_CRF', int, 23),
+    ('FFMPEG_MAXRATE', sys.intern, '200M'),
+    
+    # Logging Configuration
+    ('LOG_LEVEL', sys.intern, 'INFO'),
+    ('LOG_FILE', str, 'logs/bot.log'),
+)
+
+def _coerce(value: str | None, typ, default):
+    """Convert a raw env value to typ, falling back to default"""
+    if value is None:
+        return default
+    if typ is int:
+        # int() also accepts surrounding whitespace, a leading '+' and '_' separators
+        try:
+            return int(value)
+        except ValueError:
+            return default
+    if typ is bool:
+        return value in _TRUTHY
+    return typ(value)
+
+class _slot_cached_property:
+    """cached_property for __slots__ classes; caches into a private slot"""
+    
+    def __init__(self, func):
+        self.func = func
+        self.slot = '_' + func.__name__.lower()
+        self.__doc__ = func.__doc__
+    
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.func(obj)
+            setattr(obj, self.slot, value)
+            return value
 
 class BotConfig:
     """Bot configuration class"""
     
+    __slots__ = (
+        'BOT_TOKEN', 'OWNER_ID', 'USE_USER_CLIENT',
+        'MAX_FILE_SIZE', 'TEMP_DIR', 'MAX_WORKERS', 'PROCESSING_TIMEOUT', 'STREAM_ENCODE',
+        'SOCKET_BUSY_POLL',
+        'FFMPEG_PRESET', 'FFMPEG_CRF', 'FFMPEG_MAXRATE', 'LOG_LEVEL', 'LOG_FILE',
+        '_env', '_validated', '_ffmpeg_config', '_user_client_config',
+        # Backing slots for the lazily read user-client settings
+        '_api_id', '_api_hash', '_phone_number', '_session_name',
+    )
+    
     def __init__(self):
-        # Bot API Configuration
-        self.BOT_TOKEN: str = os.getenv('BOT_TOKEN', '')
-        self.OWNER_ID: Optional[int] = self._get_int_env('OWNER_ID')
-        
-        # User Client Configuration (Optional)
-        self.USE_USER_CLIENT: bool = os.getenv('USE_USER_CLIENT', 'true').lower() == 'true'
-        self.API_ID: Optional[int] = self._get_int_env('API_ID')
-        self.API_HASH: str = os.getenv('API_HASH', '')
-        self.PHONE_NUMBER: str = os.getenv('PHONE_NUMBER', '')
-        self.SESSION_NAME: str = os.getenv('SESSION_NAME', 'video_bot_session')
+        # Snapshot the environment once instead of calling os.getenv per key;
+        # values from the compiled .env cache are used unless the process overrides them
+        env = dict(_ENV_CACHE)
+        env.update(os.environ)
         
-        # File Configuration
-        self.MAX_FILE_SIZE: int = self._get_int_env('MAX_FILE_SIZE', 2 * 1024 * 1024 * 1024)  # 2GB
-        self.TEMP_DIR: str = os.getenv('TEMP_DIR', 'temp')
+        for name, typ, default in _SCHEMA:
+            setattr(self, name, _coerce(env.get(name), typ, default))
         
-        # Performance Configuration
-        self.MAX_WORKERS: int = self._get_int_env('MAX_WORKERS', 4)
-        self.PROCESSING_TIMEOUT: int = self._get_int_env('PROCESSING_TIMEOUT', 600)  # 10 minutes
+        # API_ID, API_HASH, PHONE_NUMBER and SESSION_NAME are read lazily below
+        self._env: dict = env
         
-        # FFmpeg Configuration
-        self.FFMPEG_PRESET: str = os.getenv('FFMPEG_PRESET', 'ultrafast')
-        self.FFMPEG_CRF: int = self._get_int_env('FFMPEG_CRF', 23)
-        self.FFMPEG_MAXRATE: str = os.getenv('FFMPEG_MAXRATE', '200M')
-        
-        # Logging Configuration
-        self.LOG_LEVEL: str = os.getenv('LOG_LEVEL', 'INFO')
-        self.LOG_FILE: str = os.getenv('LOG_FILE', 'logs/bot.log')
+        # Read-only views handed out by get_ffmpeg_config() / get_user_client_config()
+        self._ffmpeg_config = MappingProxyType({
+            'preset': self.FFMPEG_PRESET,
+            'crf': self.FFMPEG_CRF,
+            'maxrate': self.FFMPEG_MAXRATE
+        })
         
         # Validate required settings
+        self._validated: bool = False
         self._validate_config()
     
-    def _get_int_env(self, key: str, default: Optional[int] = None) -> Optional[int]:
+    @_slot_cached_property
+    def API_ID(self) -> int | None:
+        """User Client API ID (only read when User Client is enabled)"""
+        if not self.USE_USER_CLIENT:
+            return None
+        return self._get_int_env(self._env, 'API_ID')
+    
+    @_slot_cached_property
+    def API_HASH(self) -> str:
+        """User Client API hash"""
+        if not self.USE_USER_CLIENT:
+            return ''
+        return self._env.get('API_HASH', '')
+    
+    @_slot_cached_property
+    def PHONE_NUMBER(self) -> str:
+        """User Client phone number"""
+        if not self.USE_USER_CLIENT:
+            return ''
+        return self._env.get('PHONE_NUMBER', '')
+    
+    @_slot_cached_property
+    def SESSION_NAME(self) -> str:
+        """User Client session name"""
+        if not self.USE_USER_CLIENT:
+            return ''
+        return sys.intern(self._env.get('SESSION_NAME', 'video_bot_session'))
+    
+    def _get_int_env(self, env: dict, key: str, default: int | None = None) -> int | None:
         """Get integer environment variable"""
-        value = os.getenv(key)
-        if value is None:
-            return default
-        try:
-            return int(value)
-        except ValueError:
-            return default
+        return _coerce(env.get(key), int, default)
     
     def _validate_config(self):
         """Validate configuration"""
+        global _VALIDATED_FINGERPRINT
+        if self._validated:
+            return
+        
+        # Reuse the previous outcome when the relevant settings are unchanged
+        env = self._env
+        fingerprint = (
+            self.BOT_TOKEN, self.USE_USER_CLIENT, self.TEMP_DIR, self.LOG_FILE,
+            env.get('API_ID'), env.get('API_HASH'), env.get('PHONE_NUMBER')
+        )
+        if _VALIDATED_FINGERPRINT is not None and _VALIDATED_FINGERPRINT[0] == fingerprint:
+            self.USE_USER_CLIENT = _VALIDATED_FINGERPRINT[1]
+            self._validated = True
+            return
+        
         if not self.BOT_TOKEN:
             raise ValueError("BOT_TOKEN is required")
         
         if self.USE_USER_CLIENT:
-            if not all([self.API_ID, self.API_HASH, self.PHONE_NUMBER]):
+            if not (self.API_ID and self.API_HASH and self.PHONE_NUMBER):
                 print("⚠️  User Client disabled: Missing API_ID, API_HASH, or PHONE_NUMBER")
                 self.USE_USER_CLIENT = False
         
         # Create directories
-        Path(self.TEMP_DIR).mkdir(exist_ok=True)
-        Path(os.path.dirname(self.LOG_FILE)).mkdir(exist_ok=True)
-    
-    def get_user_client_config(self) -> dict:
-        """Get user client configuration"""
-        return {
-            'session_name': self.SESSION_NAME,
-            'api_id': self.API_ID,
-            'api_hash': self.API_HASH,
-            'phone_number': self.PHONE_NUMBER
-        }
-    
-    def get_ffmpeg_config(self) -> dict:
-        """Get FFmpeg configuration"""
-        return {
-            'preset': self.FFMPEG_PRESET,
-            'crf': self.FFMPEG_CRF,
-            'maxrate': self.FFMPEG_MAXRATE
-        }
-
-# Environment setup helper
-def setup_environment():
-    """Setup environment variables interactively"""
-    print("🚀 Ultra Fast Video Banner Bot - Configuration Setup")
-    print("=" * 60)
-    
-    # Bot Token
-    bot_token = input("📱 Bot Token: ").strip()
-    if not bot_token:
-        print("❌ Bot Token is required!")
-        return False
-    
-    # Owner ID (optional)
-    owner_id = input("👤 Owner ID (optional): ").strip()
-    
-    # User Client setup
-    use_user_client = input("🔄 Enable User Client? (y/n) [y]: ").strip().lower()
-    if use_user_client in ['', 'y', 'yes']:
-        print("\n🔐 User Client Setup (for large files):")
-        api_id = input("🔑 API ID (from my.telegram.org): ").strip()
-        api_hash = input("🔐 API Hash: ").strip()
-        phone_number = input("📞 Phone Number (+98912...): ").strip()
+        _ensure_dir(self.TEMP_DIR)
+        _ensure_dir(os.path.dirname(self.LOG_FILE))
         
-        if not all([api_id, api_hash, phone_number]):
-            print("⚠️  User Client will be disabled (missing credentials)")
-            use_user_client = 'n'
-    else:
-        api_id = api_hash = phone_number = ""
+        _VALIDATED_FINGERPRINT = (fingerprint, self.USE_USER_CLIENT)
+        self._validated = True
     
-    # Create .env file
-    env_content = f"""# Ultra Fast Video Banner Bot Configuration
+    def get_user_client_config(self) -> MappingProxyType:
+        """Get user client configuration (built on first call)"""
+        try:
+            return self._user_client_config
+        except AttributeError:
+            self._user_client_config = MappingProxyType({
+                'session_name': self.SESSION_NAME,
+                'api_id': self.API_ID,
+                'api_hash': self.API_HASH,
+                'phone_number': self.PHONE_NUMBER
+            })
+            return self._user_client_config
+    
+    def get_ffmpeg_config(self) -> MappingProxyType:
+        """Get FFmpeg configuration"""
+        return self._ffmpeg_config
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> BotConfig:
+    """Get the shared bot configuration (built once per process)"""
+    return BotConfig()
+
+def _parse_env(text: str) -> dict:
+    """Parse .env text into a dict (KEY=value lines, '#' comments)"""
+    env = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#') or '=' not in line:
+            continue
+        key, _, value = line.partition('=')
+        env[key.strip()] = value.split(' #', 1)[0].strip()
+    return env
+
+def _read_text(path: str) -> str | None:
+    """Read a text file, or None if it does not exist"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _update_env_text(text: str, updates: dict) -> str:
+    """Rewrite only the given keys in .env text, appending any that are missing"""
+    pending = dict(updates)
+    lines = []
+    for line in text.splitlines():
+        key = line.partition('=')[0].strip()
+        if '=' in line and not line.lstrip().startswith('#') and key in pending:
+            line = f"{key}={pending.pop(key)}"
+        lines.append(line)
+    lines.extend(f"{key}={value}" for key, value in pending.items())
+    return '\n'.join(lines) + '\n'
+
+def _prompt(label: str, current: str = '', secret: bool = False) -> str:
+    """Prompt for a value, keeping current (shown in brackets) on empty input"""
+    shown = f"...{current[-4:]}" if secret and current else current
+    hint = f" [{shown}]" if shown else ""
+    return input(f"{label}{hint}: ").strip() or current
+
+def _write_private(path: str, text: str):
+    """Write text with a single raw write, readable by the owner only"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # The O_CREAT mode only applies to new files; tighten an existing one before writing
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o600)
+        os.write(fd, text.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def _write_env_cache(env: dict, path: str = ENV_CACHE_FILE):
+    """Write env as an importable module so startup skips .env parsing"""
+    _write_private(path, f'# Generated by config.setup_environment() - do not edit\nENV = {env!r}\n')
+
+# .env file layout written by setup_environment()
+_ENV_TEMPLATE = """# Ultra Fast Video Banner Bot Configuration
 # Bot API Configuration
 BOT_TOKEN={bot_token}
 OWNER_ID={owner_id}
 
 # User Client Configuration (Optional)
-USE_USER_CLIENT={use_user_client in ['', 'y', 'yes']}
+USE_USER_CLIENT={use_user_client}
 API_ID={api_id}
 API_HASH={api_hash}
 PHONE_NUMBER={phone_number}
@@ -132,6 +292,10 @@ TEMP_DIR=temp
 # Performance Configuration
 MAX_WORKERS=4
 PROCESSING_TIMEOUT=600
+STREAM_ENCODE=False
+
+# Network Tuning (Linux, optional)
+SOCKET_BUSY_POLL=0
 
 # FFmpeg Configuration
 FFMPEG_PRESET=ultrafast
@@ -142,11 +306,64 @@ FFMPEG_MAXRATE=200M
 LOG_LEVEL=INFO
 LOG_FILE=logs/bot.log
 """
+
+# Environment setup helper
+def setup_environment():
+    """Setup environment variables interactively (keeps existing .env values)"""
+    print("🚀 Ultra Fast Video Banner Bot - Configuration Setup")
+    print("=" * 60)
+    
+    existing_text = _read_text('.env')
+    current = _parse_env(existing_text) if existing_text is not None else {}
+    
+    # Bot Token
+    bot_token = _prompt("📱 Bot Token", current.get('BOT_TOKEN', ''), secret=True)
+    if not bot_token:
+        print("❌ Bot Token is required!")
+        return False
+    
+    # Owner ID (optional)
+    owner_id = _prompt("👤 Owner ID (optional)", current.get('OWNER_ID', ''))
+    
+    # User Client setup
+    default_choice = 'y' if current.get('USE_USER_CLIENT', 'True') in _TRUTHY else 'n'
+    use_user_client = input(f"🔄 Enable User Client? (y/n) [{default_choice}]: ").strip().lower() or default_choice
+    api_id = current.get('API_ID', '')
+    api_hash = current.get('API_HASH', '')
+    phone_number = current.get('PHONE_NUMBER', '')
+    if use_user_client in ['y', 'yes']:
+        print("\n🔐 User Client Setup (for large files):")
+        api_id = _prompt("🔑 API ID (from my.telegram.org)", api_id)
+        api_hash = _prompt("🔐 API Hash", api_hash, secret=True)
+        phone_number = _prompt("📞 Phone Number (+98912...)", phone_number)
+        
+        if not all([api_id, api_hash, phone_number]):
+            print("⚠️  User Client will be disabled (missing credentials)")
+            use_user_client = 'n'
+    
+    values = {
+        'BOT_TOKEN': bot_token,
+        'OWNER_ID': owner_id,
+        'USE_USER_CLIENT': str(use_user_client in ['y', 'yes']),
+        'API_ID': api_id,
+        'API_HASH': api_hash,
+        'PHONE_NUMBER': phone_number
+    }
     
-    with open('.env', 'w', encoding='utf-8') as f:
-        f.write(env_content)
+    # Create .env file, or update only the changed keys of an existing one
+    if existing_text is None:
+        env_content = _ENV_TEMPLATE.format_map({key.lower(): value for key, value in values.items()})
+    else:
+        changed = {key: value for key, value in values.items() if current.get(key) != value}
+        env_content = _update_env_text(existing_text, changed)
+    
+    if env_content != existing_text:
+        _write_private('.env', env_content)
+        print("\n✅ Configuration saved to .env file!")
+    else:
+        print("\n✅ Configuration unchanged")
+    _write_env_cache(_parse_env(env_content))
     
-    print("\n✅ Configuration saved to .env file!")
     print("🚀 You can now run: python main.py")
     return True
 
@@ -8,30 +8,40 @@ GitHub: https://github.com/itsMoji/telegram-bot-api
 Version: 2.0
 """
 
+import io
 import os
+import socket
+import ctypes
+import ctypes.util
+import re
+import errno
+import json
+import shutil
 import logging
 import asyncio
 import sys
 import signal
+import platform
+import contextlib
 import psutil
 import tempfile
-import math
 import time
 import threading
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, Optional, List, Tuple
+from typing import Dict, Optional, List, Tuple, Union
 from enum import Enum
 from concurrent.futures import ThreadPoolExecutor
 
 # Telegram imports
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, InputFile
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    filters, ContextTypes, CallbackQueryHandler
+    filters, ContextTypes, CallbackQueryHandler, Defaults, TypeHandler
 )
 from telegram.constants import ParseMode
 from telegram.error import TelegramError, TimedOut, NetworkError
+from telegram.request import HTTPXRequest
 
 # Pyrogram imports
 from pyrogram import Client
@@ -39,8 +49,36 @@ from pyrogram.errors import FloodWait, SessionPasswordNeeded
 
 # System imports
 import subprocess
-import aiofiles
-import uvloop
+
+try:
+    import uvloop
+except ImportError:  # Windows, or not installed: stdlib asyncio is used
+    uvloop = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# fallocate(2) with FALLOC_FL_KEEP_SIZE reserves disk blocks without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+_fallocate = None
+if sys.platform.startswith('linux'):
+    try:
+        _fallocate = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).fallocate
+        _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    except (OSError, AttributeError):
+        _fallocate = None
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; only used to spot blank banners
+    Image = None
+
+try:
+    import orjson
+except ImportError:  # stdlib json is used for Bot API responses
+    orjson = None
 
 # Configure logging
 logging.basicConfig(
@@ -54,7 +92,168 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Configuration
-from config import BotConfig
+from config import get_config
+
+# Sessions idle for longer than SESSION_IDLE_TIMEOUT seconds are evicted
+SESSION_IDLE_TIMEOUT = 3600
+SESSION_EVICT_INTERVAL = 600
+
+# A chat's worker task exits after CHAT_WORKER_IDLE_TIMEOUT seconds without new updates
+CHAT_WORKER_IDLE_TIMEOUT = 300
+
+# Files in TEMP_DIR older than TEMP_FILE_MAX_AGE seconds are removed by the janitor
+TEMP_FILE_MAX_AGE = 3600
+TEMP_JANITOR_INTERVAL = 600
+
+# Units for format_file_size() and their byte divisors
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+SIZE_DIVISORS = tuple(1 << (10 * i) for i in range(len(SIZE_UNITS)))
+
+# FFmpeg output target for streaming the result to stdout, and the largest
+# source size whose output is kept in memory instead of a temp file
+FFMPEG_PIPE_OUTPUT = 'pipe:1'
+FFMPEG_PIPE_INPUT = 'pipe:0'
+PIPE_OUTPUT_MAX_SIZE = 50 * 1024 * 1024
+
+# The banner is shown for the first BANNER_SECONDS; when the source allows it,
+# only the video up to the next keyframe (at most SPLIT_MAX_HEAD_SECONDS) is re-encoded
+BANNER_SECONDS = 1
+
+# Banners are downloaded into memory and kept in the session, so they are capped
+BANNER_MAX_SIZE = 10 * 1024 * 1024
+SPLIT_MAX_HEAD_SECONDS = 10
+
+# The copied tail shares the head's avcC, so a split needs 8-bit limited-range 4:2:0
+# H.264 in one of these profiles (ffprobe name -> encoder -profile:v value)
+SPLIT_PIX_FMT = 'yuv420p'
+SPLIT_PROFILES = {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main', 'High': 'high'}
+
+# FFmpeg progress parsing: "time=HH:MM:SS.xx" in stats output, keeping
+# only the last bytes of stderr for error reporting
+FFMPEG_TIME_RE = re.compile(rb'time=(\d+):(\d+):(\d+(?:\.\d+)?)(?=\s)')
+FFMPEG_STDERR_TAIL = 64 * 1024
+
+# Kernel pipe size and StreamReader chunk limit for FFmpeg's piped stdout
+FFMPEG_PIPE_SIZE = 1024 * 1024
+FFMPEG_READ_LIMIT = 4 * 1024 * 1024
+
+# libx264 settings picked from the probed source: a slower preset for small files
+# and a keyframe every GOP_SECONDS
+VERYFAST_MAX_SIZE = 100 * 1024 * 1024
+GOP_SECONDS = 2
+
+# Disk space reserved for an output file, as a fraction of the source size
+OUTPUT_PREALLOC_DIVISOR = 3
+
+# Read/write timeout for uploading the result; other requests use the short defaults
+UPLOAD_TIMEOUT = 300
+
+# Bot-wide outgoing message budget (Telegram allows about 30 messages/s per bot)
+SEND_RATE = 28
+SEND_BURST = 30
+
+# Seconds FFmpeg gets to exit after SIGTERM on shutdown before it is killed
+FFMPEG_TERMINATE_GRACE = 5
+
+# Streamed encodes (STREAM_ENCODE) get the same 10 minutes as regular ones once the
+# download is done, and are abandoned if FFmpeg stops reading the FIFO for that long
+STREAM_ENCODE_TIMEOUT = 600
+
+# At most this many fire-and-forget replies (error notices, /help, /stats) in flight
+BACKGROUND_SEND_LIMIT = 32
+
+# SO_BUSY_POLL isn't exported by the socket module; 46 is the asm-generic value, which
+# alpha, mips, parisc and sparc don't use, so elsewhere the option is left off
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46 if platform.machine() in (
+    'x86_64', 'i386', 'i686', 'aarch64', 'armv7l', 'riscv64', 's390x', 'ppc64le'
+) else None)
+
+# Keep-alive connections shared by all Bot API calls (getUpdates has its own single connection)
+BOT_API_POOL_SIZE = 256
+
+# Upper bound on remembered stats messages before the edit-dedup cache is reset
+STATS_HASH_MAX_ENTRIES = 1024
+
+# Render node used for VAAPI (AMD/Intel) hardware encoding
+VAAPI_DEVICE = '/dev/dri/renderD128'
+
+# Next getUpdates offset, saved on shutdown so a restart keeps updates sent meanwhile
+UPDATE_OFFSET_FILE = os.path.join("sessions", "update_offset.json")
+
+# Fixed bot texts, built once; the stats templates are filled by str.format_map()
+HELP_TEXT = """
+❓ **راهنما**
+
+🚀 /start - شروع
+📊 /stats - آمار
+❓ /help - راهنما
+
+📋 **فرمت‌ها:**
+ویدیو: MP4, MOV, MKV, AVI, WEBM, FLV, WMV, MPEG, M4V, 3GP
+بنر: JPG, PNG, WEBP, GIF, BMP, TIFF, SVG, HEIC
+
+⚡ **نکات:**
+• فایل‌های بزرگ = داکیومنت
+• User Client = بدون محدودیت 20MB
+• پردازش: 15-180 ثانیه
+"""
+
+HELP_PANEL_TEXT = """
+❓ **راهنمای استفاده**
+
+🚀 **مراحل کار:**
+1️⃣ /start - شروع بات
+2️⃣ بنر را ارسال کنید
+3️⃣ ویدیو را ارسال کنید
+4️⃣ ویدیو نهایی را دریافت کنید
+
+📋 **فرمت‌های پشتیبانی:**
+• **ویدیو:** MP4, MOV, MKV, AVI, WEBM, FLV, WMV, MPEG, M4V, 3GP
+• **بنر:** JPG, PNG, WEBP, GIF, BMP, TIFF, SVG, HEIC
+
+⚡ **نکات مهم:**
+• فایل‌های بزرگ را به صورت داکیومنت بفرستید
+• User Client محدودیت 20MB ندارد
+• پردازش 15-180 ثانیه طول می‌کشد
+• بنر در ثانیه اول ویدیو اضافه می‌شود
+
+🔧 **دستورات:**
+• /start - شروع مجدد
+• /stats - آمار سیستم
+• /help - این راهنما
+"""
+
+STATS_TEMPLATE = """
+📊 **آمار سیستم**
+
+🎯 ویدیوهای پردازش شده: {processed}
+⏱️ میانگین زمان: {average:.1f}s
+🚀 سریع‌ترین: {fastest:.1f}s
+💾 بزرگ‌ترین فایل: {largest}
+❌ خطاها: {errors}
+
+💻 مدت فعالیت: {uptime}
+🔄 CPU: {cpu}% | RAM: {ram}%
+"""
+
+STATS_PANEL_TEMPLATE = """
+📊 **آمار سیستم**
+
+🎯 **عملکرد بات:**
+• ویدیوهای پردازش شده: {processed}
+• میانگین زمان پردازش: {average:.1f}s
+• سریع‌ترین پردازش: {fastest:.1f}s
+• بزرگ‌ترین فایل: {largest}
+• خطاها: {errors}
+
+💻 **سیستم:**
+• مدت فعالیت: {uptime}
+• استفاده CPU: {cpu}%
+• استفاده RAM: {ram}%
+• RAM آزاد: {ram_free}
+
+🔄 **User Client:** {client}
+"""
 
 class BotState(Enum):
     """Bot state enumeration"""
@@ -88,34 +287,192 @@ class SystemStats:
             return 0
         return self.total_processing_time / self.processed_videos
 
+class UserSession:
+    """Per-user conversation state"""
+    __slots__ = ('state', 'banner', 'banner_offset', 'processing', 'last_activity')
+    
+    def __init__(self):
+        self.state = BotState.IDLE
+        self.banner: Optional[bytes] = None
+        self.banner_offset: Tuple[int, int] = (0, 0)
+        self.processing = False
+        self.last_activity = time.monotonic()
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses (e.g. 100-update getUpdates batches) with orjson"""
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except ValueError:  # e.g. invalid UTF-8; PTB's parser replaces it or raises TelegramError
+                pass
+        return HTTPXRequest.parse_json_payload(payload)
+
+class AsyncTokenBucket:
+    """Bot-wide send limiter with last-write-wins coalescing of keyed calls"""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._pending: Dict[tuple, object] = {}
+    
+    async def acquire(self):
+        """Wait for a send token (callers are served in FIFO order)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    async def send(self, coro_factory, key: Optional[tuple] = None):
+        """Await coro_factory() once a token is free
+        
+        With a key (e.g. (chat_id, message_id) of a progress message), a newer call
+        for the same key replaces one still waiting; the replaced call returns None.
+        """
+        if key is None:
+            await self.acquire()
+            return await coro_factory()
+        waiting = key in self._pending
+        self._pending[key] = coro_factory
+        if waiting:
+            return None  # the caller already queued for this key sends the newest state
+        try:
+            await self.acquire()
+        except BaseException:
+            self._pending.pop(key, None)
+            raise
+        return await self._pending.pop(key)()
+
+class RateLimitedEditor:
+    """Progress message editor that skips redundant and too-frequent edits"""
+    def __init__(self, message, min_interval: float = 2.0, sender: Optional[AsyncTokenBucket] = None):
+        self.message = message
+        self.min_interval = min_interval
+        self.sender = sender
+        self._last = 0.0
+        self._last_pct: Optional[int] = None
+    
+    def due(self, progress: Optional[float] = None) -> bool:
+        """Whether an edit for this progress value should be sent now"""
+        if progress is not None:
+            pct = int(progress)
+            if pct == self._last_pct:
+                return False
+            if pct >= 100:
+                return True
+        return time.monotonic() - self._last >= self.min_interval
+    
+    async def edit(self, text: str, progress: Optional[float] = None, **kwargs):
+        """Edit the message if due; Telegram errors are ignored"""
+        if not self.due(progress):
+            return
+        self._last = time.monotonic()
+        if progress is not None:
+            self._last_pct = int(progress)
+        try:
+            if self.sender is None:
+                await self.message.edit_text(text, **kwargs)
+            else:
+                await self.sender.send(
+                    lambda: self.message.edit_text(text, **kwargs),
+                    key=(self.message.chat_id, self.message.message_id)
+                )
+        except TelegramError:
+            pass
+
 class VideoLogoBotPro:
     """Professional Video Logo Bot Implementation"""
     
+    # Supported formats
+    SUPPORTED_VIDEO_FORMATS = frozenset({
+        'video/mp4', 'video/quicktime', 'video/x-msvideo', 'video/x-matroska',
+        'video/webm', 'video/x-flv', 'video/x-ms-wmv', 'video/mpeg',
+        'video/mp4v-es', 'video/3gpp', 'application/octet-stream'
+    })
+    
+    SUPPORTED_IMAGE_FORMATS = frozenset({
+        'image/jpeg', 'image/png', 'image/webp', 'image/gif',
+        'image/bmp', 'image/tiff', 'image/svg+xml', 'image/heic'
+    })
+    
+    # File extensions used when a document has no MIME type
+    _IMG_EXTS = frozenset({'jpg', 'jpeg', 'png', 'webp', 'gif', 'bmp', 'tiff', 'svg', 'heic'})
+    _VID_EXTS = frozenset({'mp4', 'mov', 'mkv', 'avi', 'webm', 'flv', 'wmv', 'mpeg', 'm4v', '3gp'})
+    
+    # Built once instead of per call
+    _COMMANDS = (
+        BotCommand("start", "شروع بات"),
+        BotCommand("help", "راهنمای استفاده"),
+        BotCommand("stats", "آمار سیستم"),
+    )
+    _MD = ParseMode.MARKDOWN
+    
     def __init__(self):
-        self.config = BotConfig()
+        self.config = get_config()
         self.stats = SystemStats()
-        self.user_states: Dict[int, BotState] = {}
-        self.user_banners: Dict[int, str] = {}
-        self.processing_users: Dict[int, bool] = {}
+        self.sessions: Dict[int, UserSession] = {}
+        
+        # Each FFmpeg job gets half the cores (at least 2 threads)
+        cpus = os.cpu_count() or 4
+        self.ffmpeg_threads = max(2, cpus // 2)
+        
+        # Media updates are queued per chat and handled by lazily started worker tasks,
+        # at most MAX_WORKERS at a time, so polling never waits on FFmpeg or uploads
+        self.chat_queues: Dict[int, asyncio.Queue] = {}
+        self.chat_workers: Dict[int, asyncio.Task] = {}
+        self.worker_sema = asyncio.Semaphore(max(1, self.config.MAX_WORKERS))
+        
+        # Only the encodes themselves are bounded by the CPUs: jobs x encoder threads ~= CPUs
+        self.encode_sema = asyncio.Semaphore(max(1, cpus // self.ffmpeg_threads))
+        
+        # Replies that nobody needs to wait for run as background tasks (see _spawn())
+        self._background_tasks: set = set()
+        self._background_sema = asyncio.Semaphore(BACKGROUND_SEND_LIMIT)
+        self.send_queue = AsyncTokenBucket(rate=SEND_RATE, burst=SEND_BURST)
         self.user_client: Optional[Client] = None
+        
+        # FFmpeg runs as asyncio subprocesses; the pool only serves blocking file and image work
         self.executor = ThreadPoolExecutor(max_workers=4)
+        self.video_encoder = 'libx264'  # replaced by the startup probe in run()
+        self._probe_cache: Dict[str, dict] = {}
+        self._procs: set = set()  # running FFmpeg processes, stopped on shutdown
+        self._closing = False  # set on shutdown; no new FFmpeg processes are started
+        self.last_update_id = 0
         
-        # Supported formats
-        self.SUPPORTED_VIDEO_FORMATS = {
-            'video/mp4', 'video/quicktime', 'video/x-msvideo', 'video/x-matroska',
-            'video/webm', 'video/x-flv', 'video/x-ms-wmv', 'video/mpeg',
-            'video/mp4v-es', 'video/3gpp', 'application/octet-stream'
-        }
+        # Hash of the stats text last shown per (chat_id, message_id), to skip no-op edits
+        self._last_stats_hash: Dict[Tuple[int, int], int] = {}
         
-        self.SUPPORTED_IMAGE_FORMATS = {
-            'image/jpeg', 'image/png', 'image/webp', 'image/gif',
-            'image/bmp', 'image/tiff', 'image/svg+xml', 'image/heic'
-        }
+        # System stats are sampled in the background so handlers never block on psutil
+        self._cpu_percent = 0.0
+        self._memory_info = None
+        self._memory_checked_at = 0.0
+        threading.Thread(target=self._sample_cpu, name='cpu-sampler', daemon=True).start()
+    
+    def _sample_cpu(self):
+        """Keep a recent CPU usage reading (runs in a daemon thread)"""
+        while True:
+            self._cpu_percent = psutil.cpu_percent(interval=2.0)
+    
+    def _get_memory_info(self):
+        """Get virtual memory stats, refreshed at most once per second"""
+        now = time.monotonic()
+        if self._memory_info is None or now - self._memory_checked_at >= 1:
+            self._memory_info = psutil.virtual_memory()
+            self._memory_checked_at = now
+        return self._memory_info
     
     async def initialize_user_client(self) -> bool:
         """Initialize Pyrogram user client"""
         try:
-            if not all([self.config.API_ID, self.config.API_HASH, self.config.PHONE_NUMBER]):
+            if not (self.config.API_ID and self.config.API_HASH and self.config.PHONE_NUMBER):
                 logger.warning("User Client credentials not provided, using Bot API only")
                 return False
             
@@ -141,35 +498,100 @@ class VideoLogoBotPro:
     @staticmethod
     def format_file_size(size_bytes: int) -> str:
         """Format file size in human readable format"""
-        if size_bytes == 0:
+        if size_bytes <= 0:
             return "0B"
-        size_names = ["B", "KB", "MB", "GB", "TB"]
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return f"{s} {size_names[i]}"
-    
-    async def smart_download(self, bot, message, output_path: str, progress_callback=None) -> bool:
-        """Smart download with User Client fallback to Bot API"""
+        # Each unit is 2**10 times the previous one, so the index comes from the bit length
+        i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+        return f"{round(size_bytes / SIZE_DIVISORS[i], 2)} {SIZE_UNITS[i]}"
+    
+    async def smart_download(self, bot, message, output_path: str, progress_callback=None) -> int:
+        """Smart download with User Client fallback to Bot API (returns the size, 0 on failure)"""
         try:
             # Try User Client first
-            if self.user_client and await self._download_with_user_client(
-                message, output_path, progress_callback
-            ):
-                return True
+            if self.user_client:
+                size = await self._download_with_user_client(message, output_path, progress_callback)
+                if size:
+                    return size
             
             # Fallback to Bot API
             return await self._download_with_bot_api(bot, message, output_path, progress_callback)
             
         except Exception as e:
             logger.error(f"Smart download error: {e}")
-            return False
+            return 0
     
-    async def _download_with_user_client(self, message, output_path: str, progress_callback=None) -> bool:
+    async def smart_download_bytes(self, bot, message, progress_callback=None) -> Optional[bytes]:
+        """Download a small file (e.g. a banner) into memory, User Client first"""
+        try:
+            data = None
+            if self.user_client:
+                data = await self._download_bytes_with_user_client(message, progress_callback)
+            if not data:
+                data = await self._download_bytes_with_bot_api(bot, message, progress_callback)
+            return data or None
+            
+        except Exception as e:
+            logger.error(f"Smart download error: {e}")
+            return None
+    
+    async def _download_bytes_with_user_client(self, message, progress_callback=None) -> Optional[bytes]:
+        """Download into memory using User Client"""
+        try:
+            user_message = await self.user_client.get_messages(message.chat_id, message.message_id)
+            if not user_message:
+                return None
+            
+            async def download_progress(current, total):
+                if progress_callback and total > 0:
+                    await progress_callback((current / total) * 100)
+            
+            buffer = await self.user_client.download_media(
+                user_message,
+                in_memory=True,
+                progress=download_progress
+            )
+            return buffer.getvalue() if buffer else None
+            
+        except FloodWait as e:
+            logger.warning(f"Flood wait: {e.value} seconds")
+            await asyncio.sleep(e.value)
+            return None
+        except Exception as e:
+            logger.error(f"User client download error: {e}")
+            return None
+    
+    async def _download_bytes_with_bot_api(self, bot, message, progress_callback=None) -> Optional[bytes]:
+        """Download into memory using Bot API"""
+        try:
+            media = message.document or (message.photo[-1] if message.photo else None)
+            if not media:
+                return None
+            
+            file_obj = await bot.get_file(media.file_id)
+            data = await file_obj.download_as_bytearray()
+            
+            if progress_callback:
+                await progress_callback(100)
+            
+            return bytes(data)
+            
+        except Exception as e:
+            logger.error(f"Bot API download error: {e}")
+            return None
+    
+    @staticmethod
+    def _file_size(path: str) -> int:
+        """Size of a file in one stat() call, 0 if it is missing"""
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+    
+    async def _download_with_user_client(self, message, output_path: str, progress_callback=None) -> int:
         """Download using User Client"""
         try:
             if not self.user_client:
-                return False
+                return 0
             
             chat_id = message.chat_id
             message_id = message.message_id
@@ -177,7 +599,7 @@ class VideoLogoBotPro:
             # Get message through user client
             user_message = await self.user_client.get_messages(chat_id, message_id)
             if not user_message:
-                return False
+                return 0
             
             # Download with progress
             async def download_progress(current, total):
@@ -191,17 +613,17 @@ class VideoLogoBotPro:
                 progress=download_progress
             )
             
-            return downloaded_file and os.path.exists(output_path) and os.path.getsize(output_path) > 0
+            return self._file_size(output_path) if downloaded_file else 0
             
         except FloodWait as e:
             logger.warning(f"Flood wait: {e.value} seconds")
             await asyncio.sleep(e.value)
-            return False
+            return 0
         except Exception as e:
             logger.error(f"User client download error: {e}")
-            return False
+            return 0
     
-    async def _download_with_bot_api(self, bot, message, output_path: str, progress_callback=None) -> bool:
+    async def _download_with_bot_api(self, bot, message, output_path: str, progress_callback=None) -> int:
         """Download using Bot API"""
         try:
             file_id = None
@@ -213,7 +635,7 @@ class VideoLogoBotPro:
                 file_id = message.photo[-1].file_id
             
             if not file_id:
-                return False
+                return 0
             
             file_obj = await bot.get_file(file_id)
             await file_obj.download_to_drive(output_path)
@@ -221,78 +643,810 @@ class VideoLogoBotPro:
             if progress_callback:
                 await progress_callback(100)
             
-            return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+            return self._file_size(output_path)
             
         except Exception as e:
             logger.error(f"Bot API download error: {e}")
-            return False
+            return 0
+    
+    @staticmethod
+    def _overlay_graph(encoder: str, x: int, y: int) -> str:
+        """Banner overlay filter graph ([0:v] video, [1:v] banner -> [out]) for an encoder
+        
+        The overlay always runs on the CPU: overlay_cuda has no timeline (enable=)
+        support and can't blend an alpha banner onto NVDEC frames.
+        """
+        graph = f'[0:v][1:v]overlay={x}:{y}:enable=\'between(t,0,1)\':format=auto'
+        if encoder == 'h264_nvenc':
+            return f'{graph},format=nv12[out]'  # NVENC uploads system-memory frames itself
+        if encoder == 'h264_vaapi':
+            return f'{graph},format=nv12,hwupload[out]'
+        return f'{graph}[out]'
+    
+    @staticmethod
+    async def _run_probe(cmd: List[str], timeout: float) -> Tuple[int, str]:
+        """Run a short command without blocking the event loop, killing it on timeout"""
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            raise
+        return proc.returncode, stdout.decode(errors='replace')
     
-    def run_ffmpeg_ultra_fast(self, input_video: str, input_banner: str, output_video: str) -> Tuple[bool, str]:
-        """Ultra fast FFmpeg processing"""
+    @classmethod
+    async def _detect_video_encoder(cls) -> str:
+        """Pick the fastest working H.264 encoder (probed once at startup)"""
         try:
+            _, encoders = await cls._run_probe(['ffmpeg', '-hide_banner', '-encoders'], 10)
+        except Exception as e:
+            logger.warning(f"FFmpeg encoder probe failed: {e}")
+            return 'libx264'
+        
+        candidates = []
+        if 'h264_nvenc' in encoders:
+            candidates.append(('h264_nvenc', []))
+        if 'h264_vaapi' in encoders and os.path.exists(VAAPI_DEVICE):
+            candidates.append(('h264_vaapi', ['-vaapi_device', VAAPI_DEVICE]))
+        
+        # An encoder can be compiled in without a usable GPU, so test-encode a few frames
+        # through the same overlay graph the real jobs use
+        for encoder, extra_args in candidates:
+            test_cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error', *extra_args,
+                '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+                '-f', 'lavfi', '-i', 'color=white@0.5:s=64x64:d=0.1,format=rgba',
+                '-filter_complex', cls._overlay_graph(encoder, 0, 0),
+                '-map', '[out]', '-c:v', encoder, '-f', 'null', '-'
+            ]
+            try:
+                if (await cls._run_probe(test_cmd, 20))[0] == 0:
+                    logger.info(f"🎞️ Hardware encoder enabled: {encoder}")
+                    return encoder
+            except Exception:
+                pass
+        return 'libx264'
+    
+    async def _probe(self, path: str) -> dict:
+        """Probe a video's first stream, container and early keyframes once (cached per path)
+        
+        Returns width, height, codec, profile, pix_fmt, color_range, fps, duration,
+        size and the keyframe times (relative to the start) usable as a split point;
+        missing values are 0/None.
+        """
+        info = self._probe_cache.get(path)
+        if info is not None:
+            return info
+        
+        data = {}
+        try:
+            # One ffprobe run covers everything the encode needs, so each video costs a single spawn
+            proc = await asyncio.create_subprocess_exec(
+                'ffprobe', '-v', 'quiet', '-print_format', 'json',
+                '-select_streams', 'v:0',
+                '-skip_frame', 'nokey',
+                '-read_intervals', f'{BANNER_SECONDS}%+{SPLIT_MAX_HEAD_SECONDS}',
+                '-show_entries',
+                'stream=width,height,codec_name,profile,pix_fmt,color_range,avg_frame_rate,r_frame_rate:'
+                'format=duration,size,start_time:frame=pts_time',
+                path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            stdout, _ = await proc.communicate()
+            if proc.returncode == 0:
+                data = json.loads(stdout or b'{}')
+        except (OSError, ValueError) as e:
+            logger.warning(f"FFprobe failed for {path}: {e}")
+        
+        stream = (data.get('streams') or [{}])[0]
+        fmt = data.get('format') or {}
+        fps = 0.0
+        for rate in (stream.get('avg_frame_rate'), stream.get('r_frame_rate')):
+            num, _, den = (rate or '0/0').partition('/')
+            try:
+                fps = float(num) / float(den or 1)
+            except (ValueError, ZeroDivisionError):
+                continue
+            if fps > 0:
+                break
+        
+        def number(value, cast):
+            try:
+                return cast(value)
+            except (TypeError, ValueError):
+                return cast(0)
+        
+        # Keyframe pts_time is absolute, while -ss/-t count from the file's start_time
+        start_time = number(fmt.get('start_time'), float)
+        info = {
+            'width': number(stream.get('width'), int),
+            'height': number(stream.get('height'), int),
+            'codec': stream.get('codec_name'),
+            'profile': stream.get('profile'),
+            'pix_fmt': stream.get('pix_fmt'),
+            'color_range': stream.get('color_range'),
+            'fps': fps,
+            'duration': number(fmt.get('duration'), float),
+            'size': number(fmt.get('size'), int) or (os.path.getsize(path) if os.path.exists(path) else 0),
+            'keyframes': [
+                t for t in (
+                    number(frame.get('pts_time'), float) - start_time for frame in data.get('frames', [])
+                    if frame.get('pts_time') not in (None, 'N/A')
+                )
+                if BANNER_SECONDS <= t <= SPLIT_MAX_HEAD_SECONDS
+            ],
+        }
+        self._probe_cache[path] = info
+        return info
+    
+    def _build_ffmpeg_cmd(self, input_video: str, input_banner: str, output_video: str, encoder: str,
+                          duration: Optional[float] = None, source: Optional[dict] = None,
+                          banner_offset: Tuple[int, int] = (0, 0)) -> List[str]:
+        """Build the FFmpeg command line for the given video encoder
+        
+        With duration set, only the first `duration` seconds are encoded into
+        an MPEG-TS segment (used for the head part of a split encode).
+        `source` is the _probe() result used to tune the libx264 settings.
+        input_banner may be FFMPEG_PIPE_INPUT when the banner is fed on stdin;
+        it is overlaid with its top-left corner at banner_offset.
+        """
+        x, y = banner_offset
+        if encoder == 'h264_nvenc':
+            # Decode and encode on the GPU, overlay on the CPU in between
+            cmd = [
+                'ffmpeg', '-y', '-hide_banner',
+                '-hwaccel', 'cuda',
+                '-i', input_video,
+                '-i', input_banner,
+                '-filter_complex', self._overlay_graph(encoder, x, y),
+                '-map', '[out]',
+                '-map', '0:a?',
+                '-c:a', 'copy',
+                '-c:v', 'h264_nvenc',
+                '-preset', 'p1',
+                '-tune', 'll',
+                '-rc', 'vbr',
+                '-cq', '23',
+                '-b:v', '0'
+            ]
+        elif encoder == 'h264_vaapi':
+            # Overlay on the CPU, then upload frames for VAAPI encoding
+            cmd = [
+                'ffmpeg', '-y', '-hide_banner',
+                '-vaapi_device', VAAPI_DEVICE,
+                '-i', input_video,
+                '-i', input_banner,
+                '-filter_complex', self._overlay_graph(encoder, x, y),
+                '-map', '[out]',
+                '-map', '0:a?',
+                '-c:a', 'copy',
+                '-c:v', 'h264_vaapi',
+                '-qp', '23'
+            ]
+        else:
+            source = source or {}
+            gop = str(int(round(source['fps'] * GOP_SECONDS))) if source.get('fps') else '30'
+            preset = 'veryfast' if 0 < source.get('size', 0) < VERYFAST_MAX_SIZE else 'ultrafast'
             cmd = [
                 'ffmpeg', '-y', '-hide_banner',
                 '-i', input_video,
                 '-i', input_banner,
-                '-filter_complex',
-                '[1:v]scale=iw:ih:flags=fast_bilinear[banner];'
-                '[0:v][banner]overlay=0:0:enable=\'between(t,0,1)\':format=auto[out]',
+                '-filter_complex', self._overlay_graph(encoder, x, y),
                 '-map', '[out]',
                 '-map', '0:a?',
                 '-c:a', 'copy',
                 '-c:v', 'libx264',
-                '-preset', 'ultrafast',
+                '-preset', preset,
                 '-crf', '23',
                 '-tune', 'fastdecode',
-                '-threads', '0',
-                '-bf', '0',
-                '-refs', '1',
+                '-threads', str(self.ffmpeg_threads),
                 '-sc_threshold', '0',
-                '-g', '30',
-                '-keyint_min', '30',
-                '-movflags', '+faststart+frag_keyframe+empty_moov',
+                '-g', gop,
+                '-keyint_min', gop,
                 '-fflags', '+genpts+flush_packets',
-                '-avoid_negative_ts', 'disabled',
+                '-avoid_negative_ts', 'make_zero',
                 '-max_muxing_queue_size', '4096',
                 '-bufsize', '4M',
-                '-maxrate', '200M',
-                '-f', 'mp4',
-                output_video
+                '-maxrate', '200M'
             ]
+        
+        if duration is not None:
+            # Head of a split encode: match the copied tail's profile and pixel format
+            profile = SPLIT_PROFILES.get((source or {}).get('profile'))
+            if profile == 'baseline' and encoder == 'h264_vaapi':
+                profile = 'constrained_baseline'
+            if profile:
+                cmd += ['-profile:v', profile]
+            if encoder == 'libx264':
+                cmd += ['-pix_fmt', SPLIT_PIX_FMT]
+            return [*cmd, '-t', f'{duration:.3f}', '-f', 'mpegts', output_video]
+        
+        return [*cmd, *self._mp4_output(output_video)]
+    
+    @staticmethod
+    def _trim_banner(banner: bytes) -> Tuple[bytes, Tuple[int, int]]:
+        """Crop a banner to its non-transparent area, returning (image, top-left offset)
+        
+        Opaque or undecodable banners (or a missing Pillow) are returned unchanged at (0, 0).
+        """
+        if Image is None:
+            return banner, (0, 0)
+        try:
+            with Image.open(io.BytesIO(banner)) as img:
+                if 'transparency' in img.info:
+                    img = img.convert('RGBA')
+                if 'A' not in img.getbands():
+                    return banner, (0, 0)
+                bbox = img.getchannel('A').getbbox()
+                if bbox is None or bbox == (0, 0, *img.size):
+                    return banner, (0, 0)
+                # 4:2:0 output needs even offsets to keep the banner's position exact
+                left, top = bbox[0] & ~1, bbox[1] & ~1
+                cropped = img.crop((left, top, bbox[2], bbox[3]))
+                buffer = io.BytesIO()
+                cropped.save(buffer, format='PNG', compress_level=1)
+                return buffer.getvalue(), (left, top)
+        except Exception as e:
+            logger.warning(f"Banner trim skipped: {e}")
+            return banner, (0, 0)
+    
+    @staticmethod
+    def _mp4_output(output_video: str) -> List[str]:
+        """Trailing MP4 muxer arguments for the given output"""
+        # faststart rewrites the file after muxing, which needs a seekable output
+        if output_video == FFMPEG_PIPE_OUTPUT:
+            return ['-movflags', '+frag_keyframe+empty_moov', '-f', 'mp4', output_video]
+        # Files are emptied by _preallocate_output(); don't let FFmpeg truncate away the reserved blocks
+        return ['-movflags', '+faststart+frag_keyframe+empty_moov', '-truncate', '0', '-f', 'mp4', output_video]
+    
+    @staticmethod
+    def _preallocate_output(path: str, size: int):
+        """Empty an output file and reserve about size bytes of disk for it
+        
+        FFmpeg then writes into contiguous, already allocated blocks; blocks
+        it doesn't use are released when the temp file is deleted.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if _fallocate is not None and size > 0:
+                # Only a hint, so a failure (e.g. EOPNOTSUPP on tmpfs) is ignored
+                _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size)
+        finally:
+            os.close(fd)
+    
+    @staticmethod
+    def _banner_is_blank(banner: Union[str, bytes]) -> bool:
+        """Whether the banner has no visible pixels (False when unknown or Pillow is missing)"""
+        if Image is None:
+            return False
+        try:
+            source = io.BytesIO(banner) if isinstance(banner, (bytes, bytearray)) else banner
+            with Image.open(source) as img:
+                if 'transparency' in img.info:
+                    img = img.convert('RGBA')
+                if 'A' not in img.getbands():
+                    return False  # opaque, so it always covers something
+                return img.getchannel('A').getbbox() is None
+        except Exception:
+            return False
+    
+    @staticmethod
+    def _split_point(source: dict) -> Optional[float]:
+        """First keyframe at or after 1s of a probed H.264 video (None if unsuitable)"""
+        if (source.get('codec') != 'h264' or source.get('pix_fmt') != SPLIT_PIX_FMT
+                or source.get('color_range') == 'pc' or source.get('profile') not in SPLIT_PROFILES):
+            # The copied tail must share the re-encoded head's codec and stream format
+            return None
+        keyframes = source.get('keyframes')
+        return min(keyframes) if keyframes else None
+    
+    async def _run_ffmpeg_split(self, input_video: str, input_banner: Union[str, bytes], target: str, encoder: str,
+                                split_at: float, progress_callback=None, source: Optional[dict] = None,
+                                banner_offset: Tuple[int, int] = (0, 0)) -> Tuple[int, str, Optional[bytes]]:
+        """Overlay+encode only the head up to split_at, stream-copy the rest, then concat"""
+        work_dir = tempfile.mkdtemp(dir=self.config.TEMP_DIR)
+        try:
+            head_path = os.path.join(work_dir, 'head.ts')
+            tail_path = os.path.join(work_dir, 'tail.ts')
+            list_path = os.path.join(work_dir, 'parts.txt')
+            with open(list_path, 'w', encoding='utf-8') as list_file:
+                list_file.write("file 'head.ts'\nfile 'tail.ts'\n")
+            
+            # Pass A: banner overlay on the head only, retried in software if the hardware encoder fails
+            banner_input, banner_data = self._banner_input(input_banner)
+            for head_encoder in dict.fromkeys((encoder, 'libx264')):
+                returncode, stderr, _ = await self._run_ffmpeg_process(
+                    self._build_ffmpeg_cmd(input_video, banner_input, head_path, head_encoder,
+                                           duration=split_at, source=source, banner_offset=banner_offset),
+                    False, progress_callback, banner_data
+                )
+                if returncode == 0:
+                    break
+                logger.warning(f"Head encode with {head_encoder} failed: {stderr[-200:]}")
+            if returncode != 0:
+                return returncode, stderr, None
+            
+            # Pass B: the rest of the video is copied untouched from the keyframe on
+            returncode, stderr, _ = await self._run_ffmpeg_process([
+                'ffmpeg', '-y', '-hide_banner',
+                '-ss', f'{split_at:.3f}', '-i', input_video,
+                '-map', '0:v:0', '-map', '0:a?',
+                '-c', 'copy',
+                '-f', 'mpegts', tail_path
+            ], False)
+            if returncode != 0:
+                return returncode, stderr, None
+            
+            # Pass C: join both parts without re-encoding
+            return await self._run_ffmpeg_process([
+                'ffmpeg', '-y', '-hide_banner',
+                '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-map', '0', '-c', 'copy',
+                *self._mp4_output(target)
+            ], target == FFMPEG_PIPE_OUTPUT)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _banner_input(banner: Union[str, bytes]) -> Tuple[str, Optional[bytes]]:
+        """FFmpeg input for a banner path or in-memory banner, and the bytes to feed on stdin"""
+        if isinstance(banner, (bytes, bytearray)):
+            return FFMPEG_PIPE_INPUT, banner
+        return banner, None
+    
+    @staticmethod
+    async def _open_stdout_pipe() -> Tuple[int, asyncio.StreamReader, asyncio.ReadTransport]:
+        """Create an enlarged pipe for FFmpeg stdout, returning (write fd, reader, read transport)"""
+        read_fd, write_fd = os.pipe()
+        try:
+            # Linux pipes default to 64KB; a bigger pipe means far fewer wakeups per video
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, FFMPEG_PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass  # not Linux, or above /proc/sys/fs/pipe-max-size
+        
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=FFMPEG_READ_LIMIT, loop=loop)
+        read_pipe = os.fdopen(read_fd, 'rb', buffering=0)
+        try:
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(reader, loop=loop), read_pipe
+            )
+        except BaseException:
+            read_pipe.close()
+            os.close(write_fd)
+            raise
+        return write_fd, reader, transport
+    
+    async def _run_ffmpeg_process(self, cmd: List[str], capture_stdout: bool,
+                                  progress_callback=None,
+                                  stdin_data: Optional[bytes] = None) -> Tuple[int, str, Optional[bytes]]:
+        """Run FFmpeg on the event loop, reporting encoded seconds from its stats output
+        
+        stdin_data, if given, is written to FFmpeg's stdin (an in-memory pipe:0 input).
+        """
+        if self._closing:
+            # A terminated job must not fall back to another encode during shutdown
+            return -1, "Bot is shutting down", None
+        
+        stdout_target = asyncio.subprocess.DEVNULL
+        stdout_reader = None
+        stdout_transport = None
+        if capture_stdout and fcntl is not None:
+            stdout_target, stdout_reader, stdout_transport = await self._open_stdout_pipe()
+        elif capture_stdout:
+            stdout_target = asyncio.subprocess.PIPE
+        
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.PIPE if stdin_data is not None else asyncio.subprocess.DEVNULL,
+                stdout=stdout_target,
+                stderr=asyncio.subprocess.PIPE,
+                limit=FFMPEG_READ_LIMIT
+            )
+        except BaseException:
+            # No child will ever write, so release the read end too (e.g. ENOENT, EMFILE)
+            if stdout_transport is not None:
+                stdout_transport.close()
+            raise
+        finally:
+            if stdout_reader is not None:
+                # The child holds its own copy of the write end
+                os.close(stdout_target)
+        stdout_reader = stdout_reader or proc.stdout
+        stderr_tail = bytearray()
+        self._procs.add(proc)
+        
+        async def read_stderr():
+            # Stats lines end with '\r', so read raw chunks instead of lines
+            while True:
+                chunk = await proc.stderr.read(4096)
+                if not chunk:
+                    break
+                stderr_tail.extend(chunk)
+                del stderr_tail[:-FFMPEG_STDERR_TAIL]
+                if not progress_callback:
+                    continue
+                # Only the newest stats line matters: match at the last "time=" instead of collecting all,
+                # stepping back past one cut off at the chunk end (its value needs a trailing space)
+                match = None
+                pos = chunk.rfind(b'time=')
+                while pos >= 0:
+                    match = FFMPEG_TIME_RE.match(chunk, pos)
+                    if match:
+                        break
+                    pos = chunk.rfind(b'time=', 0, pos)
+                if match:
+                    hours, minutes, seconds = match.groups()
+                    try:
+                        await progress_callback(int(hours) * 3600 + int(minutes) * 60 + float(seconds))
+                    except Exception:
+                        pass
+        
+        async def write_stdin():
+            try:
+                proc.stdin.write(stdin_data)
+                await proc.stdin.drain()
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # FFmpeg exited early; its return code tells why
+        
+        stdin_task = asyncio.ensure_future(write_stdin()) if stdin_data is not None else None
+        stdout_task = asyncio.ensure_future(stdout_reader.read()) if capture_stdout else None
+        try:
+            await read_stderr()
+            stdout = await stdout_task if stdout_task else None
+            await proc.wait()
+        finally:
+            # Cancelled or failed mid-run: don't leave FFmpeg running
+            for task in (stdin_task, stdout_task):
+                if task and not task.done():
+                    task.cancel()
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            self._procs.discard(proc)
+        
+        return proc.returncode, stderr_tail.decode('utf-8', errors='replace'), stdout
+    
+    async def run_ffmpeg_ultra_fast(self, input_video: str, input_banner: Union[str, bytes],
+                                    output_video: Optional[str] = None,
+                                    progress_callback=None,
+                                    banner_offset: Tuple[int, int] = (0, 0)) -> Tuple[bool, str, Optional[bytes]]:
+        """Ultra fast FFmpeg processing (output_video=None returns the encoded bytes from stdout)
+        
+        input_banner is an image path, or the image itself as bytes (fed via stdin),
+        placed at banner_offset (see _trim_banner()).
+        """
+        try:
+            target = output_video or FFMPEG_PIPE_OUTPUT
+            banner_input, banner_data = self._banner_input(input_banner)
+            encoders = [self.video_encoder]
+            if self.video_encoder != 'libx264':
+                # Fall back to software encoding if the hardware pipeline fails on this input
+                encoders.append('libx264')
             
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=600,  # 10 minutes timeout
-                check=False
+            # File outputs get their disk space reserved before each attempt: a stream
+            # copy is about the source size, a re-encode usually well under it
+            source_size = self._file_size(input_video)
+            
+            def prepare_output(size):
+                if output_video:
+                    self._preallocate_output(output_video, size)
+            
+            # A fully transparent banner changes nothing, so just copy the streams
+            blank = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._banner_is_blank, input_banner
             )
+            if blank:
+                prepare_output(source_size)
+                returncode, stderr, stdout = await asyncio.wait_for(
+                    self._run_ffmpeg_process([
+                        'ffmpeg', '-y', '-hide_banner',
+                        '-i', input_video,
+                        '-map', '0:v:0', '-map', '0:a?',
+                        '-c', 'copy',
+                        *self._mp4_output(target)
+                    ], output_video is None),
+                    timeout=600
+                )
+                success = returncode == 0
+                return success, stderr, stdout if success else None
+            
+            source = await self._probe(input_video)
+            
+            # Only the first second changes, so re-encode just the head when the source allows it
+            split_at = self._split_point(source)
+            if split_at is not None:
+                prepare_output(source_size)
+                returncode, stderr, stdout = await asyncio.wait_for(
+                    self._run_ffmpeg_split(
+                        input_video, input_banner, target, self.video_encoder, split_at, progress_callback,
+                        source, banner_offset
+                    ),
+                    timeout=600
+                )
+                if returncode == 0:
+                    return True, stderr, stdout
+                logger.warning(f"Split encode failed, re-encoding whole video: {stderr[-200:]}")
+            
+            for encoder in encoders:
+                prepare_output(source_size // OUTPUT_PREALLOC_DIVISOR)
+                returncode, stderr, stdout = await asyncio.wait_for(
+                    self._run_ffmpeg_process(
+                        self._build_ffmpeg_cmd(input_video, banner_input, target, encoder,
+                                               source=source, banner_offset=banner_offset),
+                        output_video is None,
+                        progress_callback,
+                        banner_data
+                    ),
+                    timeout=600  # 10 minutes timeout
+                )
+                if returncode == 0:
+                    break
+                logger.warning(f"FFmpeg failed with {encoder}: {stderr[-200:]}")
+            
+            success = returncode == 0
+            return success, stderr, stdout if success else None
+            
+        except asyncio.TimeoutError:
+            return False, "Processing timeout - فایل خیلی بزرگ است", None
+        except Exception as e:
+            return False, str(e), None
+    
+    @staticmethod
+    async def _write_fifo(fd: int, data: bytes):
+        """Write all of data to a non-blocking FIFO, waiting on the event loop while it is full"""
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(fd, view):]
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(fd, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    # Before the caller can close fd, so no callback outlives it
+                    loop.remove_writer(fd)
+    
+    async def _stream_encode(self, message, video_path: str, banner: Union[str, bytes],
+                             output_video: Optional[str] = None,
+                             progress_callback=None,
+                             banner_offset: Tuple[int, int] = (0, 0)) -> Tuple[int, Optional[Tuple[bool, str, Optional[bytes]]]]:
+        """Download with the User Client while FFmpeg encodes from a FIFO fed by the same chunks
+        
+        The video is also saved to video_path so the regular pipeline can take
+        over if FFmpeg can't read it as a stream (e.g. MP4 with the index at the end).
+        Returns (downloaded size or 0, FFmpeg result or None if the streamed encode failed).
+        """
+        fifo_path = video_path + '.fifo'
+        fifo_fd = None
+        encode_task = None
+        try:
+            user_message = await self.user_client.get_messages(message.chat_id, message.message_id)
+            media = user_message and (user_message.video or user_message.document)
+            if not media:
+                return 0, None
+            
+            os.mkfifo(fifo_path)
+            if output_video:
+                self._preallocate_output(output_video, (media.file_size or 0) // OUTPUT_PREALLOC_DIVISOR)
+            banner_input, banner_data = self._banner_input(banner)
+            encode_task = asyncio.ensure_future(self._run_ffmpeg_process(
+                self._build_ffmpeg_cmd(fifo_path, banner_input, output_video or FFMPEG_PIPE_OUTPUT,
+                                       self.video_encoder, banner_offset=banner_offset),
+                output_video is None, None, banner_data
+            ))
             
-            return result.returncode == 0, result.stderr
+            # Opening a FIFO for writing fails with ENXIO until FFmpeg opens it for reading
+            while fifo_fd is None and not encode_task.done():
+                try:
+                    fifo_fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as e:
+                    if e.errno != errno.ENXIO:
+                        raise
+                    await asyncio.sleep(0.05)
+            
+            received = 0
+            with open(video_path, 'wb') as video_file:
+                async for chunk in self.user_client.stream_media(user_message):
+                    video_file.write(chunk)
+                    received += len(chunk)
+                    if fifo_fd is not None:
+                        try:
+                            # The FIFO fills up while FFmpeg is behind, which throttles the download to the encode
+                            await asyncio.wait_for(self._write_fifo(fifo_fd, chunk), STREAM_ENCODE_TIMEOUT)
+                        except (BrokenPipeError, asyncio.TimeoutError):
+                            # FFmpeg gave up or stalled; finish the download for the regular pipeline
+                            os.close(fifo_fd)
+                            fifo_fd = None
+                            encode_task.cancel()
+                    if progress_callback and media.file_size:
+                        await progress_callback(received * 100 / media.file_size)
             
-        except subprocess.TimeoutExpired:
-            return False, "Processing timeout - فایل خیلی بزرگ است"
+            if fifo_fd is None:
+                logger.warning("Streamed encode stopped early, using downloaded file")
+                return received, None
+            os.close(fifo_fd)
+            fifo_fd = None
+            try:
+                returncode, stderr, stdout = await asyncio.wait_for(encode_task, STREAM_ENCODE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return received, (False, "Processing timeout - فایل خیلی بزرگ است", None)
+            if returncode != 0:
+                logger.warning(f"Streamed encode failed, using downloaded file: {stderr[-200:]}")
+                return received, None
+            return received, (True, stderr, stdout)
+            
+        except FloodWait as e:
+            logger.warning(f"Flood wait: {e.value} seconds")
+            await asyncio.sleep(e.value)
+            return 0, None
         except Exception as e:
-            return False, str(e)
+            logger.error(f"Streamed download error: {e}")
+            return 0, None
+        finally:
+            if fifo_fd is not None:
+                os.close(fifo_fd)
+            if encode_task and not encode_task.done():
+                encode_task.cancel()
+            self.cleanup_temp_files(fifo_path)
+    
+    @staticmethod
+    def _read_output_file(path: str) -> bytes:
+        """Read a whole file in one pass (unbuffered, with sequential read-ahead)"""
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            # FileIO.readall() sizes its buffer from fstat, so this is a single allocation
+            return f.read()
+    
+    async def _terminate_ffmpeg(self):
+        """Ask running FFmpeg processes to exit, killing any still alive after the grace period"""
+        procs = [proc for proc in self._procs if proc.returncode is None]
+        for proc in procs:
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                pass
+        if not procs:
+            return
+        _, alive = await asyncio.wait(
+            [asyncio.ensure_future(proc.wait()) for proc in procs],
+            timeout=FFMPEG_TERMINATE_GRACE
+        )
+        for proc in procs:
+            if proc.returncode is None:
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+        for waiter in alive:
+            await waiter
     
     def cleanup_temp_files(self, *file_paths):
         """Clean up temporary files"""
         for file_path in file_paths:
-            if file_path and os.path.exists(file_path):
+            if not file_path:
+                continue
+            self._probe_cache.pop(file_path, None)
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to cleanup {file_path}: {e}")
+    
+    async def _temp_dir_janitor(self):
+        """Periodically remove stale files left in the temp directory"""
+        while True:
+            await asyncio.sleep(TEMP_JANITOR_INTERVAL)
+            cutoff = time.time() - TEMP_FILE_MAX_AGE
+            try:
+                entries = list(os.scandir(self.config.TEMP_DIR))
+            except OSError as e:
+                logger.warning(f"Temp janitor failed to scan {self.config.TEMP_DIR}: {e}")
+                continue
+            for entry in entries:
+                try:
+                    if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+    
+    def _session(self, user_id: int) -> UserSession:
+        """Get (or create) a user's session and mark it as active"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = self.sessions[user_id] = UserSession()
+        session.last_activity = time.monotonic()
+        return session
+    
+    async def _evict_idle_sessions(self):
+        """Periodically drop sessions abandoned mid-flow"""
+        while True:
+            await asyncio.sleep(SESSION_EVICT_INTERVAL)
+            cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+            for user_id, session in list(self.sessions.items()):
+                if not session.processing and session.last_activity < cutoff:
+                    del self.sessions[user_id]
+    
+    def _socket_options(self) -> List[Tuple[int, int, int]]:
+        """Socket options for Bot API connections; the Linux-only tuning is opt-in via config"""
+        options = [(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)]
+        if sys.platform.startswith('linux') and SO_BUSY_POLL is not None and self.config.SOCKET_BUSY_POLL > 0:
+            # Needs CAP_NET_ADMIN above net.core.busy_read, otherwise connecting fails
+            options.append((socket.SOL_SOCKET, SO_BUSY_POLL, self.config.SOCKET_BUSY_POLL))
+        return options
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        """Run a Telegram call in the background so a slow or rate-limited send blocks nobody"""
+        async def send():
+            async with self._background_sema:
                 try:
-                    os.unlink(file_path)
-                except Exception as e:
-                    logger.warning(f"Failed to cleanup {file_path}: {e}")
+                    await coro
+                except TelegramError as e:
+                    logger.warning(f"Background send failed: {e}")
+        
+        task = asyncio.create_task(send())
+        # The loop only keeps weak references to tasks
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+    
+    def _queued(self, handler):
+        """Wrap a handler so updates are queued for their chat's worker instead of run inline"""
+        async def enqueue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if update.effective_chat is None:  # e.g. a button on an inline message
+                return await handler(update, context)
+            chat_id = update.effective_chat.id
+            queue = self.chat_queues.get(chat_id)
+            if queue is None:
+                queue = self.chat_queues[chat_id] = asyncio.Queue()
+                self.chat_workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id, queue))
+            queue.put_nowait((handler, update, context))
+        return enqueue
+    
+    async def _chat_worker(self, chat_id: int, queue: asyncio.Queue):
+        """Handle one chat's queued updates in order; cross-chat concurrency is bounded by worker_sema"""
+        try:
+            while True:
+                try:
+                    handler, update, context = await asyncio.wait_for(queue.get(), CHAT_WORKER_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                async with self.worker_sema:
+                    try:
+                        await handler(update, context)
+                    except Exception as e:
+                        # Runs outside the dispatcher, so hand errors to the error handlers ourselves
+                        await context.application.process_error(update, e)
+        finally:
+            if self.chat_queues.get(chat_id) is queue:
+                del self.chat_queues[chat_id]
+                del self.chat_workers[chat_id]
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Start command handler"""
         user_id = update.effective_user.id
         
-        # Reset user state
-        self.user_states[user_id] = BotState.IDLE
-        if user_id in self.user_banners:
-            self.cleanup_temp_files(self.user_banners[user_id])
-            del self.user_banners[user_id]
+        # Reset user state; waiting for a banner from now on, not only once the reply is sent
+        session = self._session(user_id)
+        session.state = BotState.WAITING_BANNER
+        session.banner = None
         
         client_status = "✅ فعال" if self.user_client else "❌ غیرفعال"
         
@@ -334,94 +1488,99 @@ class VideoLogoBotPro:
         
         await update.message.reply_text(
             welcome_message,
-            parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
         )
-        
-        self.user_states[user_id] = BotState.WAITING_BANNER
     
     async def handle_banner(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle banner image upload"""
         user_id = update.effective_user.id
         
-        if self.user_states.get(user_id) != BotState.WAITING_BANNER:
+        session = self._session(user_id)
+        
+        if session.state != BotState.WAITING_BANNER:
             await update.message.reply_text("❌ لطفاً ابتدا از دستور /start استفاده کنید")
             return
         
         start_time = time.time()
         
+        media = update.message.document or (update.message.photo[-1] if update.message.photo else None)
+        if media and (media.file_size or 0) > BANNER_MAX_SIZE:
+            await update.message.reply_text(
+                f"❌ حجم بنر بیش از {self.format_file_size(BANNER_MAX_SIZE)} است"
+            )
+            return
+        
         try:
             processing_msg = await update.message.reply_text("⚡ دانلود هوشمند بنر...")
             
-            # Create temp file for banner
-            banner_temp = tempfile.NamedTemporaryFile(
-                suffix='.jpg', 
-                delete=False,
-                dir=self.config.TEMP_DIR
-            )
-            banner_path = banner_temp.name
-            banner_temp.close()
-            
             # Progress callback
+            progress_editor = RateLimitedEditor(processing_msg, sender=self.send_queue)
+            
             async def progress_callback(progress):
-                if int(progress) % 25 == 0:
-                    try:
-                        elapsed = time.time() - start_time
-                        await processing_msg.edit_text(
-                            f"⚡ دانلود بنر... {int(progress)}% ({elapsed:.1f}s)"
-                        )
-                    except:
-                        pass
+                elapsed = time.time() - start_time
+                await progress_editor.edit(
+                    f"⚡ دانلود بنر... {int(progress)}% ({elapsed:.1f}s)",
+                    progress
+                )
             
-            # Smart download
-            success = await self.smart_download(
-                context.bot, update.message, banner_path, progress_callback
+            # Banners are small and read once by FFmpeg, so keep them in memory
+            banner = await self.smart_download_bytes(
+                context.bot, update.message, progress_callback
             )
             
-            if not success:
+            if not banner:
                 await processing_msg.edit_text("❌ خطا در دانلود بنر. دوباره تلاش کنید.")
-                self.cleanup_temp_files(banner_path)
                 return
             
-            self.user_banners[user_id] = banner_path
+            banner_size = len(banner)
+            if banner_size > BANNER_MAX_SIZE:  # Telegram didn't report the size up front
+                await processing_msg.edit_text(
+                    f"❌ حجم بنر بیش از {self.format_file_size(BANNER_MAX_SIZE)} است"
+                )
+                return
+            
+            # Crop transparent margins once so FFmpeg blends only the visible part on every frame
+            session.banner, session.banner_offset = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._trim_banner, banner
+            )
             
             elapsed = time.time() - start_time
-            banner_size = os.path.getsize(banner_path)
             download_method = "User Client" if self.user_client else "Bot API"
             
             await processing_msg.edit_text(
                 f"✅ **بنر آماده!** ⚡ {elapsed:.1f}s\n\n"
                 f"📊 حجم: {self.format_file_size(banner_size)}\n"
                 f"🔄 روش: {download_method}\n\n"
-                "📹 **ویدیو را بفرستید (حجم بالا OK!)**",
-                parse_mode=ParseMode.MARKDOWN
+                "📹 **ویدیو را بفرستید (حجم بالا OK!)**"
             )
             
-            self.user_states[user_id] = BotState.WAITING_VIDEO
+            session.state = BotState.WAITING_VIDEO
             
         except Exception as e:
             logger.error(f"Banner error: {e}")
-            await update.message.reply_text(f"❌ خطا در بنر: {str(e)[:50]}")
+            await update.message.reply_text(f"❌ خطا در بنر: {str(e)[:50]}", parse_mode=None)
             self.stats.errors_count += 1
     
     async def handle_video(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle video upload and processing"""
         user_id = update.effective_user.id
         
-        if self.user_states.get(user_id) != BotState.WAITING_VIDEO:
+        session = self._session(user_id)
+        
+        if session.state != BotState.WAITING_VIDEO:
             await update.message.reply_text("❌ لطفاً ابتدا بنر خود را ارسال کنید")
             return
         
-        if user_id not in self.user_banners:
+        if not session.banner:
             await update.message.reply_text("❌ بنر پیدا نشد. از /start شروع کنید")
             return
         
-        if user_id in self.processing_users:
+        if session.processing:
             await update.message.reply_text("⚠️ در حال پردازش ویدیو قبلی هستید")
             return
         
-        self.processing_users[user_id] = True
-        self.user_states[user_id] = BotState.PROCESSING
+        session.processing = True
+        session.state = BotState.PROCESSING
         start_time = time.time()
         
         video_path = None
@@ -453,8 +1612,7 @@ class VideoLogoBotPro:
                 f"📊 حجم: {self.format_file_size(file_size)}\n"
                 f"🔄 روش: {download_method}\n"
                 f"⏱️ تخمین: {estimated_time}s\n"
-                f"⚡ دانلود هوشمند...",
-                parse_mode=ParseMode.MARKDOWN
+                f"⚡ دانلود هوشمند..."
             )
             
             # Create temp files
@@ -466,69 +1624,99 @@ class VideoLogoBotPro:
             video_path = video_temp.name
             video_temp.close()
             
-            output_temp = tempfile.NamedTemporaryFile(
-                suffix='.mp4', 
-                delete=False,
-                dir=self.config.TEMP_DIR
-            )
-            output_path = output_temp.name
-            output_temp.close()
+            # Small results are piped from FFmpeg straight into the upload;
+            # larger ones go through a temp file instead of being held in memory
+            if file_size > PIPE_OUTPUT_MAX_SIZE:
+                output_temp = tempfile.NamedTemporaryFile(
+                    suffix='.mp4', 
+                    delete=False,
+                    dir=self.config.TEMP_DIR
+                )
+                output_path = output_temp.name
+                output_temp.close()
             
             # Download video
             download_start = time.time()
             
+            progress_editor = RateLimitedEditor(processing_msg, sender=self.send_queue)
+            
             async def smart_progress(progress):
                 elapsed = time.time() - start_time
                 remaining = max(0, estimated_time - elapsed)
-                try:
-                    await processing_msg.edit_text(
-                        f"⚡ **دانلود... {int(progress)}%** ({elapsed:.1f}s)\n\n"
-                        f"📊 حجم: {self.format_file_size(file_size)}\n"
-                        f"🔄 روش: {download_method}\n"
-                        f"⏱️ باقی‌مانده: ~{remaining:.0f}s",
-                        parse_mode=ParseMode.MARKDOWN
-                    )
-                except:
-                    pass
+                await progress_editor.edit(
+                    f"⚡ **دانلود... {int(progress)}%** ({elapsed:.1f}s)\n\n"
+                    f"📊 حجم: {self.format_file_size(file_size)}\n"
+                    f"🔄 روش: {download_method}\n"
+                    f"⏱️ باقی‌مانده: ~{remaining:.0f}s",
+                    progress
+                )
             
-            success = await self.smart_download(
-                context.bot, update.message, video_path, smart_progress
-            )
+            banner = session.banner
+            
+            # With STREAM_ENCODE, FFmpeg encodes the video while it is still downloading
+            streamed = None
+            downloaded_size = 0
+            if self.config.STREAM_ENCODE and self.user_client and hasattr(os, 'mkfifo'):
+                async with self.encode_sema:
+                    downloaded_size, streamed = await self._stream_encode(
+                        update.message, video_path, banner, output_path, smart_progress, session.banner_offset
+                    )
+            if not downloaded_size:
+                downloaded_size = await self.smart_download(
+                    context.bot, update.message, video_path, smart_progress
+                )
             
-            if not success:
+            if not downloaded_size:
                 await processing_msg.edit_text("❌ خطا در دانلود ویدیو")
                 return
             
             download_time = time.time() - download_start
-            banner_path = self.user_banners[user_id]
+            file_size = file_size or downloaded_size
             
             # Process video
             process_start = time.time()
-            await processing_msg.edit_text(
-                f"⚡ **پردازش ویدیو...** ({time.time() - start_time:.1f}s)\n\n"
-                f"✅ دانلود: {download_time:.1f}s\n"
-                f"🔄 اضافه کردن بنر...",
-                parse_mode=ParseMode.MARKDOWN
-            )
-            
-            # Run FFmpeg
-            def run_ffmpeg():
-                return self.run_ffmpeg_ultra_fast(video_path, banner_path, output_path)
-            
-            try:
-                success, error_msg = await asyncio.wait_for(
-                    asyncio.get_event_loop().run_in_executor(self.executor, run_ffmpeg),
-                    timeout=300
+            if streamed is not None:
+                success, error_msg, video_data = streamed
+            else:
+                await processing_msg.edit_text(
+                    f"⚡ **پردازش ویدیو...** ({time.time() - start_time:.1f}s)\n\n"
+                    f"✅ دانلود: {download_time:.1f}s\n"
+                    f"🔄 اضافه کردن بنر..."
                 )
-            except asyncio.TimeoutError:
-                await processing_msg.edit_text("❌ زمان پردازش تمام شد")
-                return
+                
+                # Run FFmpeg
+                ffmpeg_editor = RateLimitedEditor(processing_msg, min_interval=3.0, sender=self.send_queue)
+                
+                async def ffmpeg_progress(encoded_seconds):
+                    await ffmpeg_editor.edit(
+                        f"⚡ **پردازش ویدیو...** ({time.time() - start_time:.1f}s)\n\n"
+                        f"✅ دانلود: {download_time:.1f}s\n"
+                        f"🔄 اضافه کردن بنر... ⏱️ {encoded_seconds:.0f}s"
+                    )
+                
+                try:
+                    async with self.encode_sema:
+                        success, error_msg, video_data = await asyncio.wait_for(
+                            self.run_ffmpeg_ultra_fast(
+                                video_path, banner, output_path, ffmpeg_progress, session.banner_offset
+                            ),
+                            timeout=300
+                        )
+                except asyncio.TimeoutError:
+                    await processing_msg.edit_text("❌ زمان پردازش تمام شد")
+                    return
             
             process_time = time.time() - process_start
             
-            if success and os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if video_data is not None:
+                output_size = len(video_data)
+            elif success and output_path:
+                output_size = self._file_size(output_path)
+            else:
+                output_size = 0
+            
+            if success and output_size > 0:
                 total_time = time.time() - start_time
-                output_size = os.path.getsize(output_path)
                 
                 # Update stats
                 self.stats.update_processing_stats(total_time, file_size)
@@ -536,14 +1724,9 @@ class VideoLogoBotPro:
                 await processing_msg.edit_text(
                     f"✅ **آماده!** 🚀 {total_time:.1f}s\n\n"
                     f"📊 حجم نهایی: {self.format_file_size(output_size)}\n"
-                    f"🔄 آپلود...",
-                    parse_mode=ParseMode.MARKDOWN
+                    f"🔄 آپلود..."
                 )
                 
-                # Upload result
-                async with aiofiles.open(output_path, 'rb') as video_file:
-                    video_content = await video_file.read()
-                
                 caption = (
                     f"✅ **ویدیو آماده!** 🚀 {total_time:.1f}s\n"
                     f"⚡ دانلود: {download_time:.1f}s ({download_method})\n"
@@ -553,44 +1736,57 @@ class VideoLogoBotPro:
                     f"🔄 /start برای ویدیو جدید"
                 )
                 
+                # Upload result straight from FFmpeg's output, or read the temp file off the event loop
+                if video_data is None:
+                    video_data = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self._read_output_file, output_path
+                    )
+                video_input = InputFile(video_data, filename='output.mp4')
                 if output_size > 50 * 1024 * 1024:  # >50MB as document
                     await update.message.reply_document(
-                        document=video_content,
+                        document=video_input,
                         caption=caption,
-                        parse_mode=ParseMode.MARKDOWN
+                        read_timeout=UPLOAD_TIMEOUT,
+                        write_timeout=UPLOAD_TIMEOUT
                     )
                 else:
                     await update.message.reply_video(
-                        video=video_content,
+                        video=video_input,
                         caption=caption,
-                        parse_mode=ParseMode.MARKDOWN
+                        read_timeout=UPLOAD_TIMEOUT,
+                        write_timeout=UPLOAD_TIMEOUT
                     )
                 
                 await processing_msg.delete()
-                self.user_states[user_id] = BotState.IDLE
+                if session.state == BotState.PROCESSING:  # unless /start already moved on
+                    session.state = BotState.IDLE
                 
+            elif self._closing:
+                # FFmpeg was stopped by shutdown; that is not a processing error
+                logger.info(f"Video job for {user_id} stopped by shutdown")
             else:
                 await processing_msg.edit_text(
                     f"❌ **خطا در پردازش**\n"
-                    f"جزئیات: {error_msg[:100] if error_msg else 'نامشخص'}"
+                    f"جزئیات: {error_msg[:100] if error_msg else 'نامشخص'}",
+                    parse_mode=None
                 )
                 self.stats.errors_count += 1
                 
         except Exception as e:
+            if self._closing:
+                logger.info(f"Video job for {user_id} stopped by shutdown: {e}")
+                return
             elapsed = time.time() - start_time
             logger.error(f"Video processing error: {e}")
-            await update.message.reply_text(f"❌ خطا ({elapsed:.1f}s): {str(e)[:80]}")
+            await update.message.reply_text(f"❌ خطا ({elapsed:.1f}s): {str(e)[:80]}", parse_mode=None)
             self.stats.errors_count += 1
             
         finally:
             # Cleanup
             self.cleanup_temp_files(video_path, output_path)
-            if user_id in self.user_banners:
-                self.cleanup_temp_files(self.user_banners[user_id])
-                del self.user_banners[user_id]
+            session.banner = None
             
-            if user_id in self.processing_users:
-                del self.processing_users[user_id]
+            session.processing = False
     
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle document upload"""
@@ -601,14 +1797,16 @@ class VideoLogoBotPro:
             await self.handle_wrong_content(update, context)
             return
         
+        state = self._session(user_id).state
+        
         # Check if it's a video document
-        if (self.user_states.get(user_id) == BotState.WAITING_VIDEO and 
+        if (state == BotState.WAITING_VIDEO and 
             self._is_supported_video(document)):
             await self.handle_video(update, context)
             return
         
         # Check if it's a banner document
-        if (self.user_states.get(user_id) == BotState.WAITING_BANNER and 
+        if (state == BotState.WAITING_BANNER and 
             self._is_supported_image(document)):
             await self.handle_banner(update, context)
             return
@@ -617,26 +1815,28 @@ class VideoLogoBotPro:
     
     def _is_supported_image(self, file_obj) -> bool:
         """Check if file is supported image format"""
-        if hasattr(file_obj, 'mime_type') and file_obj.mime_type:
-            return file_obj.mime_type in self.SUPPORTED_IMAGE_FORMATS
-        if hasattr(file_obj, 'file_name') and file_obj.file_name:
-            ext = file_obj.file_name.lower().split('.')[-1]
-            return ext in ['jpg', 'jpeg', 'png', 'webp', 'gif', 'bmp', 'tiff', 'svg', 'heic']
+        mime_type = getattr(file_obj, 'mime_type', None)
+        if mime_type:
+            return mime_type in self.SUPPORTED_IMAGE_FORMATS
+        file_name = getattr(file_obj, 'file_name', None)
+        if file_name:
+            return file_name.rpartition('.')[2].lower() in self._IMG_EXTS
         return True
     
     def _is_supported_video(self, file_obj) -> bool:
         """Check if file is supported video format"""
-        if hasattr(file_obj, 'mime_type') and file_obj.mime_type:
-            return file_obj.mime_type in self.SUPPORTED_VIDEO_FORMATS
-        if hasattr(file_obj, 'file_name') and file_obj.file_name:
-            ext = file_obj.file_name.lower().split('.')[-1]
-            return ext in ['mp4', 'mov', 'mkv', 'avi', 'webm', 'flv', 'wmv', 'mpeg', 'm4v', '3gp']
+        mime_type = getattr(file_obj, 'mime_type', None)
+        if mime_type:
+            return mime_type in self.SUPPORTED_VIDEO_FORMATS
+        file_name = getattr(file_obj, 'file_name', None)
+        if file_name:
+            return file_name.rpartition('.')[2].lower() in self._VID_EXTS
         return True
     
     async def handle_wrong_content(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle wrong content type"""
         user_id = update.effective_user.id
-        current_state = self.user_states.get(user_id, BotState.IDLE)
+        current_state = self._session(user_id).state
         
         if current_state == BotState.WAITING_BANNER:
             await update.message.reply_text(
@@ -660,8 +1860,12 @@ class VideoLogoBotPro:
         
         await query.answer()
         
+        if query.data != "stats" and query.message:
+            # The message is about to show something else, so the next stats view must be sent
+            self._last_stats_hash.pop((query.message.chat_id, query.message.message_id), None)
+        
         if query.data == "send_banner":
-            self.user_states[user_id] = BotState.WAITING_BANNER
+            self._session(user_id).state = BotState.WAITING_BANNER
             client_status = "✅ فعال" if self.user_client else "❌ غیرفعال"
             await query.edit_message_text(
                 f"⚡ **بنر خود را ارسال کنید**\n\n"
@@ -670,8 +1874,7 @@ class VideoLogoBotPro:
                 f"• دانلود بدون محدودیت 20MB\n"
                 f"• سرعت بالاتر\n"
                 f"• فالبک خودکار\n"
-                f"🔄 وضعیت: {client_status}",
-                parse_mode=ParseMode.MARKDOWN
+                f"🔄 وضعیت: {client_status}"
             )
         
         elif query.data == "stats":
@@ -683,72 +1886,51 @@ class VideoLogoBotPro:
         elif query.data == "settings":
             await self._show_settings(query)
     
+    def _stats_fields(self) -> dict:
+        """Values substituted into the stats templates"""
+        system_info = self._get_memory_info()
+        fastest = self.stats.fastest_processing_time
+        return {
+            'processed': self.stats.processed_videos,
+            'average': self.stats.get_average_processing_time(),
+            'fastest': fastest if fastest != float('inf') else 0,
+            'largest': self.format_file_size(self.stats.largest_file_size),
+            'errors': self.stats.errors_count,
+            'uptime': self.stats.get_uptime(),
+            'cpu': self._cpu_percent,
+            'ram': system_info.percent,
+            'ram_free': self.format_file_size(system_info.available),
+            'client': "✅ فعال" if self.user_client else "❌ غیرفعال",
+        }
+    
     async def _show_stats(self, query):
         """Show system statistics"""
-        system_info = psutil.virtual_memory()
-        cpu_percent = psutil.cpu_percent(interval=1)
+        stats_text = STATS_PANEL_TEMPLATE.format_map(self._stats_fields())
         
-        stats_text = f"""
-📊 **آمار سیستم**
-
-🎯 **عملکرد بات:**
-• ویدیوهای پردازش شده: {self.stats.processed_videos}
-• میانگین زمان پردازش: {self.stats.get_average_processing_time():.1f}s
-• سریع‌ترین پردازش: {self.stats.fastest_processing_time if self.stats.fastest_processing_time != float('inf') else 0:.1f}s
-• بزرگ‌ترین فایل: {self.format_file_size(self.stats.largest_file_size)}
-• خطاها: {self.stats.errors_count}
-
-💻 **سیستم:**
-• مدت فعالیت: {self.stats.get_uptime()}
-• استفاده CPU: {cpu_percent}%
-• استفاده RAM: {system_info.percent}%
-• RAM آزاد: {self.format_file_size(system_info.available)}
-
-🔄 **User Client:** {"✅ فعال" if self.user_client else "❌ غیرفعال"}
-"""
+        # Telegram rejects edits that change nothing ("Message is not modified")
+        key = (query.message.chat_id, query.message.message_id)
+        text_hash = hash(stats_text)
+        if self._last_stats_hash.get(key) == text_hash:
+            return
+        if len(self._last_stats_hash) >= STATS_HASH_MAX_ENTRIES:
+            self._last_stats_hash.clear()
+        self._last_stats_hash[key] = text_hash
         
         keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await query.edit_message_text(
+        await self.send_queue.send(lambda: query.edit_message_text(
             stats_text,
-            parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
-        )
+        ), key=key)
     
     async def _show_help(self, query):
         """Show help information"""
-        help_text = """
-❓ **راهنمای استفاده**
-
-🚀 **مراحل کار:**
-1️⃣ /start - شروع بات
-2️⃣ بنر را ارسال کنید
-3️⃣ ویدیو را ارسال کنید
-4️⃣ ویدیو نهایی را دریافت کنید
-
-📋 **فرمت‌های پشتیبانی:**
-• **ویدیو:** MP4, MOV, MKV, AVI, WEBM, FLV, WMV, MPEG, M4V, 3GP
-• **بنر:** JPG, PNG, WEBP, GIF, BMP, TIFF, SVG, HEIC
-
-⚡ **نکات مهم:**
-• فایل‌های بزرگ را به صورت داکیومنت بفرستید
-• User Client محدودیت 20MB ندارد
-• پردازش 15-180 ثانیه طول می‌کشد
-• بنر در ثانیه اول ویدیو اضافه می‌شود
-
-🔧 **دستورات:**
-• /start - شروع مجدد
-• /stats - آمار سیستم
-• /help - این راهنما
-"""
-        
         keyboard = [[InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_main")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(
-            help_text,
-            parse_mode=ParseMode.MARKDOWN,
+            HELP_PANEL_TEXT,
             reply_markup=reply_markup
         )
     
@@ -759,14 +1941,14 @@ class VideoLogoBotPro:
 
 🔧 **پیکربندی فعلی:**
 • حداکثر اندازه فایل: {self.format_file_size(self.config.MAX_FILE_SIZE)}
-• دایرکتوری موقت: {self.config.TEMP_DIR}
+• دایرکتوری موقت: `{self.config.TEMP_DIR}`
 • تعداد Thread: {self.executor._max_workers}
 • User Client: {"✅ فعال" if self.user_client else "❌ غیرفعال"}
 
 📊 **تنظیمات FFmpeg:**
 • Preset: ultrafast
 • CRF: 23
-• Codec: libx264
+• Codec: `{self.video_encoder}`
 • Max Rate: 200M
 
 ⚠️ **تنظیمات پیشرفته فقط برای ادمین**
@@ -777,183 +1959,241 @@ class VideoLogoBotPro:
         
         await query.edit_message_text(
             settings_text,
-            parse_mode=ParseMode.MARKDOWN,
             reply_markup=reply_markup
         )
     
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Stats command handler"""
-        await self._show_stats_message(update.message)
+        self._spawn(self._show_stats_message(update.message))
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Help command handler"""
-        await self._show_help_message(update.message)
+        self._spawn(self._show_help_message(update.message))
     
     async def _show_stats_message(self, message):
         """Show stats as message"""
-        system_info = psutil.virtual_memory()
-        cpu_percent = psutil.cpu_percent(interval=1)
+        stats_text = STATS_TEMPLATE.format_map(self._stats_fields())
         
-        stats_text = f"""
-📊 **آمار سیستم**
-
-🎯 ویدیوهای پردازش شده: {self.stats.processed_videos}
-⏱️ میانگین زمان: {self.stats.get_average_processing_time():.1f}s
-🚀 سریع‌ترین: {self.stats.fastest_processing_time if self.stats.fastest_processing_time != float('inf') else 0:.1f}s
-💾 بزرگ‌ترین فایل: {self.format_file_size(self.stats.largest_file_size)}
-❌ خطاها: {self.stats.errors_count}
-
-💻 مدت فعالیت: {self.stats.get_uptime()}
-🔄 CPU: {cpu_percent}% | RAM: {system_info.percent}%
-"""
-        
-        await message.reply_text(stats_text, parse_mode=ParseMode.MARKDOWN)
+        await self.send_queue.send(lambda: message.reply_text(stats_text))
     
     async def _show_help_message(self, message):
         """Show help as message"""
-        help_text = """
-❓ **راهنما**
-
-🚀 /start - شروع
-📊 /stats - آمار
-❓ /help - راهنما
-
-📋 **فرمت‌ها:**
-ویدیو: MP4, MOV, MKV, AVI, WEBM, FLV, WMV, MPEG, M4V, 3GP
-بنر: JPG, PNG, WEBP, GIF, BMP, TIFF, SVG, HEIC
-
-⚡ **نکات:**
-• فایل‌های بزرگ = داکیومنت
-• User Client = بدون محدودیت 20MB
-• پردازش: 15-180 ثانیه
-"""
-        
-        await message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+        await self.send_queue.send(lambda: message.reply_text(HELP_TEXT))
     
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Global error handler"""
         logger.error(f"Error: {context.error}")
         
-        if update and update.effective_message:
-            try:
-                await update.effective_message.reply_text(
-                    "❌ **خطای سیستم!**\n\n"
-                    "🔄 /start کنید یا چند لحظه صبر کنید",
-                    parse_mode=ParseMode.MARKDOWN
-                )
-            except:
-                pass
+        if isinstance(update, Update) and update.effective_message:
+            message = update.effective_message
+            self._spawn(self.send_queue.send(lambda: message.reply_text(
+                "❌ **خطای سیستم!**\n\n"
+                "🔄 /start کنید یا چند لحظه صبر کنید"
+            )))
         
         self.stats.errors_count += 1
     
     async def setup_bot_commands(self, application):
         """Setup bot commands"""
-        commands = [
-            BotCommand("start", "شروع بات"),
-            BotCommand("help", "راهنمای استفاده"),
-            BotCommand("stats", "آمار سیستم"),
-        ]
+        await application.bot.set_my_commands(self._COMMANDS)
+    
+    async def _track_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Remember the newest dispatched update id"""
+        if update.update_id > self.last_update_id:
+            self.last_update_id = update.update_id
+    
+    @staticmethod
+    def _load_update_offset() -> Optional[int]:
+        """Offset saved by the previous run, None on first boot"""
+        try:
+            with open(UPDATE_OFFSET_FILE) as f:
+                return int(json.load(f)["offset"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+    
+    def _save_update_offset(self, offset: Optional[int]):
+        """Persist the offset after the newest dispatched update (kept as is if none arrived)
         
-        await application.bot.set_my_commands(commands)
+        Sessions live in memory only, so a job cut off by shutdown can't resume after a
+        restart; replaying its update would only hit an IDLE session.
+        """
+        if self.last_update_id:
+            offset = self.last_update_id + 1
+        tmp_path = UPDATE_OFFSET_FILE + '.tmp'
+        try:
+            # Written aside and renamed, so a crash never leaves a truncated file
+            with open(tmp_path, 'w') as f:
+                json.dump({"offset": offset or 0}, f)
+            os.replace(tmp_path, UPDATE_OFFSET_FILE)
+        except OSError as e:
+            logger.warning(f"Could not save update offset: {e}")
+    
+    async def _cancel_tasks(self, *tasks):
+        """Cancel tasks and wait until they have all finished unwinding"""
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
     
-    async def run(self):
-        """Main run method"""
+    async def _stop_workers(self):
+        """Stop running FFmpeg gracefully, then cancel chat workers and background sends"""
+        # Terminate first: cancelling a worker SIGKILLs its FFmpeg in _run_ffmpeg_process()
+        self._closing = True
+        await self._terminate_ffmpeg()
+        await self._cancel_tasks(*self.chat_workers.values(), *self._background_tasks)
+    
+    def _shutdown_executor(self):
+        """Finish reads already running, drop queued ones (cancel_futures is 3.9+)"""
+        if sys.version_info >= (3, 9):
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.executor.shutdown(wait=True)
+    
+    async def run(self, stop: Optional[asyncio.Event] = None):
+        """Main run method (runs until stop is set)"""
+        stop = stop or asyncio.Event()
         try:
-            # Setup directories
-            Path(self.config.TEMP_DIR).mkdir(exist_ok=True)
-            Path("sessions").mkdir(exist_ok=True)
-            Path("logs").mkdir(exist_ok=True)
-            
-            # Initialize User Client
-            if self.config.USE_USER_CLIENT:
-                await self.initialize_user_client()
-            
-            # Create application
-            application = (
-                Application.builder()
-                .token(self.config.BOT_TOKEN)
-                .read_timeout(300)
-                .write_timeout(300)
-                .connect_timeout(60)
-                .pool_timeout(60)
-                .get_updates_read_timeout(60)
-                .get_updates_write_timeout(60)
-                .get_updates_connect_timeout(30)
-                .build()
-            )
-            
-            # Add handlers
-            application.add_handler(CommandHandler("start", self.start_command))
-            application.add_handler(CommandHandler("help", self.help_command))
-            application.add_handler(CommandHandler("stats", self.stats_command))
-            application.add_handler(CallbackQueryHandler(self.button_callback))
-            application.add_handler(MessageHandler(filters.PHOTO, self.handle_banner))
-            application.add_handler(MessageHandler(filters.VIDEO, self.handle_video))
-            application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
-            application.add_handler(MessageHandler(~filters.COMMAND, self.handle_wrong_content))
-            application.add_error_handler(self.error_handler)
-            
-            # Setup bot commands
-            await self.setup_bot_commands(application)
-            
-            # Initialize and start
-            await application.initialize()
-            await application.start()
-            await application.updater.start_polling(
-                allowed_updates=Update.ALL_TYPES,
-                timeout=60,
-                drop_pending_updates=True
-            )
-            
-            logger.info("✅ Bot started successfully!")
-            logger.info(f"🎯 Target processing time: 15-180 seconds")
-            logger.info(f"📱 User Client: {'✅ Active' if self.user_client else '❌ Inactive'}")
-            logger.info(f"🔄 Smart fallback enabled")
-            
-            # Keep running
-            try:
-                await application.updater.idle()
-            except KeyboardInterrupt:
-                logger.info("🛑 Stopping bot...")
-            finally:
-                await application.updater.stop()
-                await application.stop()
-                await application.shutdown()
+            # Every startup step registers its teardown as soon as it succeeds, so a
+            # failure half way (e.g. start_polling raising) unwinds only what was started
+            async with contextlib.AsyncExitStack() as teardown:
+                teardown.callback(self._shutdown_executor)
+                
+                # Setup directories
+                Path(self.config.TEMP_DIR).mkdir(exist_ok=True)
+                Path("sessions").mkdir(exist_ok=True)
+                Path("logs").mkdir(exist_ok=True)
+                
+                # Probe the encoders asynchronously, so startup still reacts to signals
+                self.video_encoder = await self._detect_video_encoder()
                 
-                if self.user_client:
-                    await self.user_client.stop()
+                # Initialize User Client
+                if self.config.USE_USER_CLIENT and await self.initialize_user_client():
+                    teardown.push_async_callback(self.user_client.stop)
                 
-                self.executor.shutdown(wait=True)
+                # Create application
+                # One connection pool serves every Bot API call, including uploads and
+                # replies from the chat workers. Short timeouts so dead sockets are
+                # noticed quickly; uploads override them per call
+                socket_options = self._socket_options()
+                self.bot_request = OrjsonRequest(
+                    connection_pool_size=BOT_API_POOL_SIZE,
+                    socket_options=socket_options,
+                    read_timeout=60,
+                    write_timeout=60,
+                    connect_timeout=60,
+                    pool_timeout=10
+                )
+                updates_request = OrjsonRequest(
+                    connection_pool_size=1,
+                    socket_options=socket_options,
+                    read_timeout=35,
+                    write_timeout=20,
+                    connect_timeout=30
+                )
+                application = (
+                    Application.builder()
+                    .token(self.config.BOT_TOKEN)
+                    # Markdown for every send unless a call passes parse_mode=None (raw error
+                    # text); handlers never block the dispatcher
+                    .defaults(Defaults(parse_mode=self._MD, block=False))
+                    .request(self.bot_request)
+                    .get_updates_request(updates_request)
+                    # Each getUpdates batch (Bot API default limit: the maximum of 100) is
+                    # dispatched concurrently; media handlers only enqueue, see _queued()
+                    .concurrent_updates(True)
+                    .build()
+                )
+                
+                # Add handlers
+                application.add_handler(TypeHandler(Update, self._track_update, block=True), group=-1)
+                # Handlers that change a user's session state share the chat's queue with
+                # the media handlers, so they apply in the order the user sent them
+                application.add_handler(CommandHandler("start", self._queued(self.start_command)))
+                application.add_handler(CommandHandler("help", self.help_command))
+                application.add_handler(CommandHandler("stats", self.stats_command))
+                application.add_handler(CallbackQueryHandler(self._queued(self.button_callback), pattern="^send_banner$"))
+                application.add_handler(CallbackQueryHandler(self.button_callback))
+                application.add_handler(MessageHandler(filters.PHOTO, self._queued(self.handle_banner)))
+                application.add_handler(MessageHandler(filters.VIDEO, self._queued(self.handle_video)))
+                application.add_handler(MessageHandler(filters.Document.ALL, self._queued(self.handle_document)))
+                application.add_handler(MessageHandler(~filters.COMMAND, self._queued(self.handle_wrong_content)))
+                application.add_error_handler(self.error_handler)
+                
+                # Initialize and start
+                await application.initialize()
+                teardown.push_async_callback(application.shutdown)
+                # Saved last, once nothing can dispatch updates any more
+                offset = self._load_update_offset()
+                teardown.callback(self._save_update_offset, offset)
+                # Workers stop only after the updater and application: stop() still dispatches
+                # the queued updates, which may start new chat workers
+                teardown.push_async_callback(self._stop_workers)
+                await application.start()
+                teardown.push_async_callback(application.stop)
+                
+                # Pending updates are only dropped on first boot; after a restart the
+                # saved offset confirms what was handled and the rest is processed
+                if offset is not None:
+                    await application.bot.get_updates(offset=offset, limit=1, timeout=0)
+                await application.updater.start_polling(
+                    allowed_updates=Update.ALL_TYPES,
+                    # PTB adds the long-poll timeout to the 35s read timeout: ~1 minute on a dead socket
+                    timeout=25,
+                    drop_pending_updates=offset is None
+                )
+                teardown.push_async_callback(application.updater.stop)
+                
+                # Setup bot commands; the command menu may land a moment later, polling already runs
+                self._spawn(self.setup_bot_commands(application))
+                
+                teardown.push_async_callback(
+                    self._cancel_tasks,
+                    asyncio.create_task(self._evict_idle_sessions()),
+                    asyncio.create_task(self._temp_dir_janitor())
+                )
+                
+                logger.info("✅ Bot started successfully!")
+                logger.info(f"🎯 Target processing time: 15-180 seconds")
+                logger.info(f"📱 User Client: {'✅ Active' if self.user_client else '❌ Inactive'}")
+                logger.info(f"🔄 Smart fallback enabled")
+                
+                # Keep running; the teardown always runs, also on cancellation (Ctrl+C on Windows)
+                await stop.wait()
+                logger.info("🛑 Stopping bot...")
                 
         except Exception as e:
             logger.error(f"❌ Bot startup failed: {e}")
             raise
 
-def signal_handler(signum, frame):
-    """Handle shutdown signals"""
-    logger.info(f"Received signal {signum}, shutting down...")
-    sys.exit(0)
-
 async def main():
     """Main entry point"""
-    # Set event loop policy for better performance
-    if sys.platform != 'win32':
-        uvloop.install()
-    
-    # Setup signal handlers
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    # Shutdown signals set the stop event, so run() can clean up before returning
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:  # Windows: Ctrl+C cancels main() instead
+            pass
     
     # Create and run bot
     bot = VideoLogoBotPro()
-    await bot.run()
+    await bot.run(stop)
 
 if __name__ == '__main__':
     print("🚀 Ultra Fast Video Banner Bot Pro - Starting...")
     print("=" * 60)
     
     try:
-        asyncio.run(main())
+        # uvloop for better performance; uvloop.install() is deprecated on 3.12+
+        if uvloop is None or sys.platform == 'win32':
+            asyncio.run(main())
+        elif hasattr(uvloop, 'run'):
+            uvloop.run(main())
+        elif sys.version_info >= (3, 12):
+            asyncio.run(main(), loop_factory=uvloop.new_event_loop)
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            asyncio.run(main())
     except KeyboardInterrupt:
         print("\n🛑 Bot stopped by user")
     except Exception as e: